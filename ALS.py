@@ -0,0 +1,281 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+import Concurrency
+import Database
+import Metrics
+
+# Every signal is summed per (user, product); orders that never went through
+# do not count as purchases. taste_preferences.item_id is a product id.
+INTERACTION_QUERIES = {
+    "purchase": "SELECT o.user_id, pd.product_id, SUM(COALESCE(d.quantity, 1)) AS value "
+                "FROM order_detail d JOIN `order` o ON o.id = d.order_id "
+                "JOIN product_detail pd ON pd.id = d.product_detail_id "
+                "WHERE o.user_id IS NOT NULL AND pd.product_id IS NOT NULL "
+                "AND (o.status IS NULL OR o.status NOT IN ('CANCELED', 'FAILED')) "
+                "GROUP BY o.user_id, pd.product_id",
+    "wishlist": "SELECT w.user_id, wi.product_id, COUNT(*) AS value "
+                "FROM wishlist_item wi JOIN wishlist w ON w.id = wi.wishlist_id "
+                "WHERE w.user_id IS NOT NULL AND wi.product_id IS NOT NULL "
+                "GROUP BY w.user_id, wi.product_id",
+    "taste": "SELECT user_id, item_id AS product_id, preference AS value FROM taste_preferences "
+             "WHERE preference > 0",
+}
+INTERACTION_DTYPES = {"user_id": np.int64, "product_id": np.int64, "value": np.float64}
+
+
+def load_interactions(db):
+    frames = []
+    for source, query in INTERACTION_QUERIES.items():
+        frame = pd.read_sql(query, db, dtype=INTERACTION_DTYPES)
+        frame["source"] = source
+        frames.append(frame)
+    return pd.concat(frames, ignore_index=True)
+
+
+class ALSModel:
+    # Implicit-feedback matrix factorization (Hu, Koren and Volinsky): every
+    # interaction strength r gives a confidence 1 + alpha * r that the user
+    # prefers the product, and the factors are fitted by alternating least
+    # squares, each row solved with a few conjugate gradient steps.
+    factors = 64
+    regularization = 0.1
+    alpha = 20.0
+    iterations = 15
+    cg_steps = 3
+    threads = 4
+    # Strength of each signal, added up over log-scaled counts.
+    source_weights = {"purchase": 1.0, "wishlist": 0.5, "taste": 0.3}
+    # Upper bound on the floats a solving or scoring step builds.
+    score_block = 1 << 20
+    seed = 0
+
+    def __init__(self, df, version, **params):
+        for name, value in params.items():
+            if value is not None:
+                setattr(self, name, value)
+        self.version = version
+        self.trained_at = time.time()
+
+        weights = df["source"].map(self.source_weights).fillna(0).to_numpy(np.float64)
+        df = df.assign(strength=weights * np.log1p(df["value"].clip(lower=0).to_numpy(np.float64)))
+        df = df[df["strength"] > 0].groupby(["user_id", "product_id"], as_index=False, sort=False)["strength"].sum()
+        user_codes, user_ids = pd.factorize(df["user_id"])
+        product_codes, product_ids = pd.factorize(df["product_id"])
+        self.user_ids = np.asarray(user_ids, dtype=np.int64)
+        self.product_ids = np.asarray(product_ids, dtype=np.int64)
+        self.user_order = np.argsort(self.user_ids, kind="stable")
+        self.sorted_user_ids = self.user_ids[self.user_order]
+        shape = (len(self.user_ids), len(self.product_ids))
+        self.strength = sp.csr_matrix((df["strength"].to_numpy(np.float32), (user_codes, product_codes)),
+                                      shape=shape)
+        self.strength.sum_duplicates()
+        self.strength.sort_indices()
+
+        popularity = np.asarray(self.strength.sum(axis=0)).ravel()
+        self.popular = self.product_ids[np.lexsort((self.product_ids, -popularity))]
+        self.user_factors, self.product_factors = self.fit(self.strength)
+
+    def fit(self, strength):
+        rng = np.random.default_rng(self.seed)
+        users = (rng.standard_normal((strength.shape[0], self.factors)) * 0.01).astype(np.float32)
+        products = (rng.standard_normal((strength.shape[1], self.factors)) * 0.01).astype(np.float32)
+        # Only alpha * r is stored: the 1 of every confidence is folded into
+        # the Gram matrix shared by all rows.
+        weights = strength * np.float32(self.alpha)
+        weights_t = weights.T.tocsr()
+        # The numpy and scipy kernels release the GIL, so blocks of rows are
+        # solved on threads sharing the factors.
+        with ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix="als") as pool:
+            for _ in range(self.iterations):
+                self.solve(pool, weights, users, products)
+                self.solve(pool, weights_t, products, users)
+        return users, products
+
+    def solve(self, pool, weights, x, y):
+        # Updates x in place for fixed y. Every block writes its own rows.
+        gram = y.T @ y + self.regularization * np.eye(self.factors, dtype=np.float32)
+        blocks = self.row_blocks(weights)
+        for _ in pool.map(lambda rows: self.solve_rows(weights, x, y, gram, rows), blocks):
+            pass
+
+    def row_blocks(self, weights):
+        # A block's cost is its dense rows plus one factor row per entry.
+        cost = (np.diff(weights.indptr) + 1) * self.factors
+        blocks = np.cumsum(cost) // self.score_block
+        return np.split(np.arange(weights.shape[0]), np.flatnonzero(np.diff(blocks)) + 1)
+
+    def solve_rows(self, weights, x, y, gram, rows):
+        if len(rows) == 0:
+            return
+        block = weights[rows[0]:rows[-1] + 1]
+        entries = np.repeat(np.arange(len(rows)), np.diff(block.indptr))
+        observed = y[block.indices]
+
+        def product(v):
+            # (Y'Y + reg I + Y' (C - I) Y) v for every row at once.
+            dots = np.einsum("ij,ij->i", observed, v[entries])
+            spread = sp.csr_matrix((block.data * dots, block.indices, block.indptr), shape=block.shape)
+            return v @ gram + spread @ y
+
+        # The right-hand side Y' C p: confidences of the observed products.
+        ones = sp.csr_matrix((block.data + 1, block.indices, block.indptr), shape=block.shape)
+        solution = x[rows].copy()
+        residual = ones @ y - product(solution)
+        direction = residual.copy()
+        norms = np.einsum("ij,ij->i", residual, residual)
+        for _ in range(self.cg_steps):
+            applied = product(direction)
+            curvature = np.einsum("ij,ij->i", direction, applied)
+            step = np.divide(norms, curvature, out=np.zeros_like(norms), where=curvature > 0)
+            solution += step[:, None] * direction
+            residual -= step[:, None] * applied
+            new_norms = np.einsum("ij,ij->i", residual, residual)
+            direction = residual + np.divide(new_norms, norms, out=np.zeros_like(norms),
+                                             where=norms > 0)[:, None] * direction
+            norms = new_norms
+        x[rows] = solution
+
+    def user_rows(self, user_ids):
+        ids = np.asarray(user_ids, dtype=np.int64)
+        if len(self.sorted_user_ids) == 0:
+            return np.full(ids.shape, -1)
+        positions = np.minimum(np.searchsorted(self.sorted_user_ids, ids), len(self.sorted_user_ids) - 1)
+        return np.where(self.sorted_user_ids[positions] == ids, self.user_order[positions], -1)
+
+    def top_n(self, rows, n):
+        n = min(n, len(self.product_ids))
+        if n <= 0:
+            return [[] for _ in rows]
+        scores = self.user_factors[rows] @ self.product_factors.T
+        # Products the user already interacted with are left out.
+        scores[self.strength[rows].nonzero()] = -np.inf
+        results = []
+        for row_scores in scores:
+            candidates = np.argpartition(-row_scores, n - 1)[:n]
+            threshold = row_scores[candidates].min()
+            candidates = np.flatnonzero((row_scores >= threshold) & (row_scores > -np.inf))
+            top = candidates[np.lexsort((self.product_ids[candidates], -row_scores[candidates]))[:n]]
+            results.append(self.product_ids[top].tolist())
+        return results
+
+    def iter_recommendation_blocks(self, user_ids, n=10):
+        # Like KNNModel.iter_recommendation_blocks: one list of pairs per
+        # scoring block, cold starts going out with the block before them.
+        cold_start = self.get_top_rated_products(n)
+        rows = self.user_rows(user_ids)
+        known = np.flatnonzero(rows >= 0)
+        Metrics.ALS_LOOKUPS.inc(len(known))
+        Metrics.COLD_START_LOOKUPS.inc(len(rows) - len(known))
+        block_rows = max(1, self.score_block // max(1, len(self.product_ids)))
+        results = [cold_start] * len(user_ids)
+        begin = 0
+        for done in range(0, len(known), block_rows):
+            block = known[done:done + block_rows]
+            for position, products in zip(block, self.top_n(rows[block], n)):
+                results[position] = products or cold_start
+            end = known[done + block_rows] if done + block_rows < len(known) else len(user_ids)
+            yield list(zip(user_ids[begin:end], results[begin:end]))
+            begin = end
+        if begin < len(user_ids):
+            yield list(zip(user_ids[begin:], results[begin:]))
+
+    def get_top_rated_products(self, n):
+        return self.popular[:max(n, 0)].tolist()
+
+    def get_recommendations(self, user_id: int, n: int = 10):
+        row = self.user_rows(user_id)
+        if row < 0:
+            Metrics.COLD_START_LOOKUPS.inc()
+            return self.get_top_rated_products(n)
+        Metrics.ALS_LOOKUPS.inc()
+        with Metrics.stage("als_score"):
+            top_n_product_ids = self.top_n(np.array([row]), n)[0]
+        return top_n_product_ids or self.get_top_rated_products(n)
+
+
+def train_model(db, version, params):
+    # Like KNN.train_model: ``db`` is a URL in a worker process, and the
+    # stage durations are returned for the caller to observe.
+    if isinstance(db, str):
+        db = Database.get_engine(db)
+    durations = {}
+    with Metrics.stage("als_load_interactions", durations):
+        interactions = load_interactions(db)
+    with Metrics.stage("als_fit", durations):
+        model = ALSModel(interactions, version, **params)
+    return model, durations
+
+
+class ALS:
+    def __init__(self, db_url, executor=None, factors=None, regularization=None, alpha=None, iterations=None,
+                 threads=None):
+        self.db_url = db_url
+        self.db = Database.get_engine(db_url)
+        self.executor = executor
+        self.params = {"factors": factors, "regularization": regularization, "alpha": alpha,
+                       "iterations": iterations, "threads": threads}
+        self.model = None
+        self.version = 0
+        self._refresher = None
+        self._stop_refresher = threading.Event()
+        self._flights = Concurrency.SingleFlight()
+
+    def load_data_and_train(self):
+        return self._flights.run("reload", self._train)
+
+    def _train(self):
+        version = self.version + 1
+        with Metrics.stage("als_train"):
+            if self.executor is None:
+                model, durations = train_model(self.db, version, self.params)
+            else:
+                model, durations = self.executor.submit(train_model, self.db_url, version, self.params).result()
+        Metrics.observe_stages(durations)
+        self.version = version
+        self.model = model
+        return model
+
+    def start_refresher(self, interval):
+        if interval <= 0 or self._refresher is not None:
+            return
+        self._stop_refresher.clear()
+        self._refresher = threading.Thread(target=self._refresh_loop, args=(interval,),
+                                           name="als-refresher", daemon=True)
+        self._refresher.start()
+
+    def stop_refresher(self):
+        if self._refresher is None:
+            return
+        self._stop_refresher.set()
+        self._refresher.join()
+        self._refresher = None
+
+    def _refresh_loop(self, interval):
+        # Trains right away, so startup does not wait for it, then retrains
+        # fully every interval: there is no incremental update.
+        wait = 0
+        while not self._stop_refresher.wait(wait):
+            wait = interval
+            try:
+                self.load_data_and_train()
+            except Exception as e:
+                print("ALS refresh failed, keeping model version %s: %s" % (self.version, e))
+
+    def get_model(self):
+        model = self.model
+        if model is None:
+            model = self.load_data_and_train()
+        return model
+
+    def iter_recommendation_blocks(self, user_ids, n=10):
+        return self.get_model().iter_recommendation_blocks(user_ids, n)
+
+    def get_recommendations(self, user_id: int, n: int = 10):
+        model = self.get_model()
+        return self._flights.run(("user", user_id, n, model.version), model.get_recommendations, user_id, n)
@@ -0,0 +1,54 @@
+import json
+import os
+import struct
+
+import numpy as np
+
+MAGIC = b"ARRS"
+ALIGNMENT = 64
+
+
+def _aligned(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def save_arrays(path, arrays, meta=None):
+    # Layout: magic, header length, JSON header, then every array's raw bytes
+    # at an aligned offset so each one can be memory-mapped in place.
+    arrays = {name: np.ascontiguousarray(a) for name, a in arrays.items()}
+    entries = []
+    offset = 0
+    for name, a in arrays.items():
+        entries.append({"name": name, "dtype": a.dtype.str, "shape": list(a.shape), "offset": offset})
+        offset = _aligned(offset + a.nbytes)
+    header = json.dumps({"meta": meta or {}, "arrays": entries}).encode("utf-8")
+    data_start = _aligned(len(MAGIC) + 4 + len(header))
+
+    tmp_path = "%s.%s.tmp" % (path, os.getpid())
+    with open(tmp_path, "wb") as f:
+        f.write(MAGIC + struct.pack("<I", len(header)) + header)
+        for entry, a in zip(entries, arrays.values()):
+            f.seek(data_start + entry["offset"])
+            a.tofile(f)
+        f.truncate(data_start + offset)
+    # Readers that already mapped the old file keep their pages.
+    os.replace(tmp_path, path)
+
+
+def load_arrays(path):
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("%s is not an array store file" % path)
+        header_length, = struct.unpack("<I", f.read(4))
+        header = json.loads(f.read(header_length).decode("utf-8"))
+    data_start = _aligned(len(MAGIC) + 4 + header_length)
+
+    arrays = {}
+    for entry in header["arrays"]:
+        dtype, shape = np.dtype(entry["dtype"]), tuple(entry["shape"])
+        if np.prod(shape, dtype=np.int64) == 0:
+            arrays[entry["name"]] = np.empty(shape, dtype=dtype)
+        else:
+            arrays[entry["name"]] = np.memmap(path, dtype=dtype, mode="r", shape=shape,
+                                              offset=data_start + entry["offset"])
+    return arrays, header["meta"]
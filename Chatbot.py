@@ -1,11 +1,16 @@
+import asyncio
+
+from langchain.agents import AgentExecutor
 from langchain_community.agent_toolkits import create_sql_agent, SQLDatabaseToolkit
 from langchain_core.prompts import FewShotPromptTemplate, PromptTemplate, ChatPromptTemplate, \
     SystemMessagePromptTemplate, MessagesPlaceholder
 from langchain_openai import ChatOpenAI
-from langchain_community.utilities import SQLDatabase
-from langchain_community.vectorstores import Chroma
-from langchain_core.example_selectors import SemanticSimilarityExampleSelector
 from langchain_openai import OpenAIEmbeddings
+from Database import CachedSQLDatabase, get_engine
+from ExampleIndex import ExampleIndex
+from QuestionCache import QuestionCache, context_key
+import MemoryStore
+import Metrics
 
 
 class SQLAgent:
@@ -776,25 +781,50 @@ class SQLAgent:
     (You do not need to use these pieces of information if not relevant)
     """
 
-    def __init__(self, db_uri, memory):
+    def __init__(self, db_uri, llm=None, embeddings=None, example_index_path=None, schema_check_interval=60,
+                 cache_threshold=0.95, cache_ttl=600, cache_size=1000, db_options=None, verbose=True):
+        # The LLM client, toolkit, example index and prompt are built once per
+        # process; conversations only differ by the memory given to ``run``.
         self.db_uri = db_uri
-        self.db = SQLDatabase.from_uri(db_uri, sample_rows_in_table_info=3)
-        self.memory = memory
-
-    def create_agent(self):
-        llm = ChatOpenAI(model=self.model, temperature=0)
-        toolkit = SQLDatabaseToolkit(db=self.db, llm=llm)
-        vector_store = Chroma()
-        vector_store.delete_collection()
-        example_selector = SemanticSimilarityExampleSelector.from_examples(
+        self.schema_check_interval = schema_check_interval
+        self.verbose = verbose
+        # Row and size caps and result caching for the agent's SQL, see
+        # CachedSQLDatabase.
+        self.db_options = db_options or {}
+        self.db = self.connect()
+        self.llm = llm or ChatOpenAI(model=self.model, temperature=0)
+        self.embeddings = embeddings or OpenAIEmbeddings()
+        # The example embeddings are read from here when still current.
+        self.example_selector = ExampleIndex(
             self.examples,
-            OpenAIEmbeddings(),
-            vector_store,
+            self.embeddings,
+            path=example_index_path,
             k=5,
             input_keys=["input"]
         )
+        self.agent = self.create_agent()
+        # Answers to near-repeat questions; a cache_size of 0 disables it.
+        self.question_cache = None
+        if cache_size > 0:
+            self.question_cache = QuestionCache(self.embeddings, threshold=cache_threshold, ttl=cache_ttl,
+                                                max_entries=cache_size, data_version=lambda: self.db.data_version())
+            # The few-shot pairs show which questions embed alike but need
+            # different SQL; their vectors are already in the example index.
+            self.question_cache.calibrate([e["input"] for e in self.examples], [e["query"] for e in self.examples],
+                                          self.example_selector.vectors)
+
+    def connect(self):
+        # Conversations may be stored in the same database; the agent must
+        # never read them, and saving one must not drop cached results.
+        return CachedSQLDatabase(get_engine(self.db_uri), sample_rows_in_table_info=3,
+                                 schema_check_interval=self.schema_check_interval,
+                                 hidden_tables=[MemoryStore.SQLSessionBackend.table_name], **self.db_options)
+
+    def create_agent(self):
+        # The table info is rendered into the prompt here, once per schema.
+        toolkit = SQLDatabaseToolkit(db=self.db, llm=self.llm)
         few_shot_prompt = FewShotPromptTemplate(
-            example_selector=example_selector,
+            example_selector=self.example_selector,
             example_prompt=PromptTemplate.from_template(
                 "User input: {input}\nSQL query: {query}"
             ),
@@ -812,16 +842,84 @@ class SQLAgent:
         )
 
         agent = create_sql_agent(
-            llm=llm,
+            llm=self.llm,
             toolkit=toolkit,
             prompt=full_prompt,
-            verbose=True,
+            verbose=self.verbose,
             agent_type="openai-tools",
-            agent_executor_kwargs={'memory': self.memory}
         )
         return agent
 
-    def run(self, input_text):
-        agent = self.create_agent()
+    def executor(self, memory):
+        if self.db.schema_changed():
+            # Calls already running finish on the previous agent.
+            self.db = self.connect()
+            self.agent = self.create_agent()
+        # Every call shares the built agent and tools; only the memory is per
+        # conversation, so concurrent calls do not interfere.
+        built = self.agent
+        return AgentExecutor(name=built.name, agent=built.agent, tools=built.tools, memory=memory,
+                             verbose=self.verbose)
+
+    def cached_answer(self, input_text, memory):
+        # Returns (answer or None, context, vector); a hit is recorded in the
+        # conversation just like an answer from the agent.
+        if self.question_cache is None:
+            return None, None, None
+        context = context_key(memory.chat_memory.messages)
+        # Embedded once per turn: the example selector finds the same vector
+        # when the agent formats its prompt.
+        vector = self.example_selector.embed(self.example_selector.text({"input": input_text}))
+        answer, vector = self.question_cache.lookup(input_text, context, vector)
+        Metrics.QUESTION_CACHE.labels("miss" if answer is None else "hit").inc()
+        if answer is not None:
+            memory.save_context({"input": input_text}, {"output": answer})
+        return answer, context, vector
+
+    def cache_answer(self, input_text, answer, context, vector):
+        # Answers cut short by the agent's limits are not worth repeating.
+        if self.question_cache is not None and answer and not answer.startswith("Agent stopped"):
+            self.question_cache.store(input_text, answer, context, vector)
+
+    def run(self, input_text, memory):
+        answer, context, vector = self.cached_answer(input_text, memory)
+        if answer is not None:
+            return {"input": input_text, "output": answer}
+        agent = self.executor(memory)
         response = agent.invoke({"input": input_text})
+        self.cache_answer(input_text, response["output"], context, vector)
         return response
+
+    async def astream(self, input_text, memory):
+        # Yields (event, data) pairs: tool progress, answer tokens as the LLM
+        # produces them, then the complete answer once memory is saved.
+        answer, context, vector = await asyncio.to_thread(self.cached_answer, input_text, memory)
+        if answer is not None:
+            yield "token", {"content": answer}
+            yield "end", {"output": answer}
+            return
+        # Building the agent can hit the database for the schema, so it stays
+        # off the event loop like the cache lookup.
+        agent = await asyncio.to_thread(self.executor, memory)
+        root = None
+        # Tools running, whose own LLM calls (the query checker) stream too
+        # but are not part of the answer.
+        tools = 0
+        async for event in agent.astream_events({"input": input_text}, version="v1"):
+            kind = event["event"]
+            if root is None:
+                root = event["run_id"]
+            if kind == "on_tool_start":
+                tools += 1
+                yield "tool_start", {"tool": event["name"]}
+            elif kind == "on_tool_end":
+                tools -= 1
+                yield "tool_end", {"tool": event["name"]}
+            elif kind == "on_chat_model_stream" and not tools:
+                content = event["data"]["chunk"].content
+                if content:
+                    yield "token", {"content": content}
+            elif kind == "on_chain_end" and event["run_id"] == root:
+                answer = event["data"]["output"]["output"]
+                await asyncio.to_thread(self.cache_answer, input_text, answer, context, vector)
+                yield "end", {"output": answer}
@@ -0,0 +1,133 @@
+import asyncio
+import contextlib
+import functools
+import threading
+from concurrent.futures import Future
+
+
+class Saturated(Exception):
+    pass
+
+
+class Busy(Exception):
+    # Raised when one user already has as many turns in flight as allowed.
+    pass
+
+
+class BoundedExecutor:
+    # At most ``workers`` calls run at once and ``queue_limit`` more wait for
+    # a worker; beyond that, or after waiting ``queue_timeout`` seconds, a
+    # call fails with Saturated instead of piling up.
+    def __init__(self, executor, workers, queue_limit, queue_timeout=None):
+        self.executor = executor
+        self.max_pending = workers + queue_limit
+        self.queue_timeout = queue_timeout
+        self.pending = 0
+        self.running = asyncio.Semaphore(workers)
+
+    def saturated(self):
+        return self.pending >= self.max_pending
+
+    @contextlib.asynccontextmanager
+    async def slot(self):
+        # Only touched from the event loop thread, so no lock is needed.
+        if self.saturated():
+            raise Saturated()
+        self.pending += 1
+        try:
+            try:
+                await asyncio.wait_for(self.running.acquire(), self.queue_timeout)
+            except asyncio.TimeoutError:
+                raise Saturated()
+            try:
+                yield
+            finally:
+                self.running.release()
+        finally:
+            self.pending -= 1
+
+    async def run(self, fn, *args, **kwargs):
+        async with self.slot():
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, functools.partial(fn, *args, **kwargs))
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+class UserGate:
+    # Turns of one user run one at a time, with at most ``max_pending`` in
+    # flight (running or waiting) before Busy is raised; a turn identical to
+    # one in flight, like a double-clicked send, shares its result.
+    def __init__(self, max_pending=2):
+        self.max_pending = max_pending
+        self.turns = {}
+        self.flights = {}
+
+    def busy(self, user):
+        turn = self.turns.get(user)
+        return turn is not None and turn[1] >= self.max_pending
+
+    @contextlib.asynccontextmanager
+    async def turn(self, user):
+        if self.busy(user):
+            raise Busy()
+        turn = self.turns.setdefault(user, [asyncio.Lock(), 0])
+        turn[1] += 1
+        try:
+            async with turn[0]:
+                yield
+        finally:
+            turn[1] -= 1
+            if not turn[1]:
+                del self.turns[user]
+
+    async def run(self, user, key, fn, *args, **kwargs):
+        flight = self.flights.get((user, key))
+        if flight is None:
+            if self.busy(user):
+                raise Busy()
+            flight = asyncio.ensure_future(self._run(user, fn, *args, **kwargs))
+            self.flights[(user, key)] = flight
+            flight.add_done_callback(functools.partial(self._landed, (user, key)))
+        # A caller going away must not cancel the turn for the others.
+        return await asyncio.shield(flight)
+
+    def _landed(self, flight_key, flight):
+        self.flights.pop(flight_key, None)
+        # Retrieved here, so a failure every caller abandoned is not logged
+        # as never retrieved.
+        if not flight.cancelled():
+            flight.exception()
+
+    async def _run(self, user, fn, *args, **kwargs):
+        async with self.turn(user):
+            return await fn(*args, **kwargs)
+
+
+class SingleFlight:
+    # For threads: concurrent calls with the same key share one execution and
+    # its result or exception; a call arriving after it finished runs anew.
+    def __init__(self):
+        self.calls = {}
+        self._lock = threading.Lock()
+
+    def run(self, key, fn, *args, **kwargs):
+        with self._lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = Future()
+        if not leader:
+            return call.result()
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as e:
+            call.set_exception(e)
+            raise
+        else:
+            call.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self.calls[key]
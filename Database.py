@@ -0,0 +1,252 @@
+import hashlib
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from langchain_community.utilities import SQLDatabase
+from langchain_community.utilities.sql_database import truncate_word
+from sqlalchemy import Text, bindparam, create_engine, inspect, make_url, text
+from sqlalchemy.exc import DBAPIError, InvalidRequestError
+
+import Metrics
+
+# Also a parenthesized query, like "(SELECT ...) UNION (SELECT ...)".
+READ_QUERY = re.compile(r"[\s(]*(select|with)\b", re.IGNORECASE)
+# Whitespace and comments outside of string literals and quoted names. A
+# comment runs to the end of its line, so it goes before lines are joined.
+QUERY_SPACE = re.compile(r"('(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"|`[^`]*`)"
+                         r"|(?:--(?=\s|$)[^\n]*|#[^\n]*|/\*(?!!).*?\*/|\s)+", re.DOTALL)
+# The row count is the first number, or the second after a comma (MySQL's
+# LIMIT offset, count).
+TRAILING_LIMIT = re.compile(r"\blimit\s+(\d+)(?:\s*,\s*(\d+)|\s+offset\s+\d+)?$", re.IGNORECASE)
+# SELECT * from a single table, optionally aliased, with no join.
+SELECT_STAR = re.compile(r"select \* from ([`\"]?)(\w+)\1((?: (?:as )?(?!where\b|order\b|group\b|limit\b)\w+)?"
+                         r"(?: (?:where|order|group|limit)\b.*)?)$", re.IGNORECASE | re.DOTALL)
+
+
+_engines = {}
+_engines_lock = threading.Lock()
+
+
+def get_engine(url, pool_size=5, max_overflow=10, pool_timeout=30, pool_recycle=1800, pool_pre_ping=True):
+    # One engine, and so one connection pool, per database URL and process.
+    # The pool options of the first call for a URL are the ones that apply.
+    with _engines_lock:
+        engine = _engines.get(url)
+        if engine is None:
+            options = {}
+            # SQLite connections are local files, not worth pooling options.
+            if make_url(url).get_backend_name() != "sqlite":
+                options = {"pool_size": pool_size, "max_overflow": max_overflow, "pool_timeout": pool_timeout,
+                           "pool_recycle": pool_recycle, "pool_pre_ping": pool_pre_ping}
+            engine = create_engine(url, **options)
+            Metrics.watch_pool(engine)
+            _engines[url] = engine
+        return engine
+
+
+def normalize_query(query):
+    query = QUERY_SPACE.sub(lambda m: m.group(1) or " ", query).strip()
+    return query.rstrip(";").strip()
+
+
+class CachedSQLDatabase(SQLDatabase):
+    # Table info (columns plus sample rows) is built once per set of tables
+    # and kept until the schema checksum changes. Read queries from the agent
+    # are capped at ``max_rows`` rows and ``max_result_chars`` characters,
+    # skip text columns longer than ``wide_column_length`` when selecting *,
+    # and their results are cached for ``result_ttl`` seconds or until the
+    # data version (checked every ``data_check_interval`` seconds) changes.
+    # ``hidden_tables``, like the chat sessions, are never shown to the agent
+    # and writes to them do not change the data version.
+    def __init__(self, engine, *args, schema_check_interval=60, max_rows=50, max_result_chars=8000,
+                 wide_column_length=1000, result_ttl=60, result_cache_size=256, data_check_interval=10,
+                 hidden_tables=(), **kwargs):
+        # SQLDatabase rejects ignored tables that do not exist (yet).
+        present = set(inspect(engine).get_table_names(schema=kwargs.get("schema")))
+        self.hidden_tables = [table for table in hidden_tables if table in present]
+        # Left out of the table info is not enough: the agent may still guess
+        # the name, so queries mentioning one are refused.
+        self.hidden_query = re.compile(r"\b(%s)\b" % "|".join(map(re.escape, self.hidden_tables)),
+                                       re.IGNORECASE) if self.hidden_tables else None
+        kwargs["ignore_tables"] = list(kwargs.get("ignore_tables") or []) + self.hidden_tables
+        super().__init__(engine, *args, **kwargs)
+        self.schema_check_interval = schema_check_interval
+        self.data_check_interval = data_check_interval
+        self.max_rows = max_rows
+        self.max_result_chars = max_result_chars
+        self.result_ttl = result_ttl
+        self.result_cache_size = result_cache_size
+        self._table_info = {}
+        self._results = OrderedDict()
+        self._lock = threading.Lock()
+        self.checksum = self.schema_checksum()
+        self._checked_at = time.monotonic()
+        self.version = self.data_version()
+        self._version_checked_at = time.monotonic()
+        self.narrow_columns = self.find_narrow_columns(wide_column_length)
+
+    def find_narrow_columns(self, wide_column_length):
+        # Columns of every table that has text columns too long for a prompt.
+        narrow = {}
+        for table in self._metadata.sorted_tables:
+            wide = []
+            for column in table.columns:
+                length = getattr(column.type, "length", None)
+                if (length or 0) > wide_column_length or isinstance(column.type, Text) and length is None:
+                    wide.append(column)
+            if wide:
+                narrow[table.name.lower()] = ([c.name for c in table.columns if c not in wide], [c.name for c in wide])
+        return narrow
+
+    def run(self, command, fetch="all", include_columns=False, *, parameters=None, execution_options=None):
+        if self.hidden_query is not None and isinstance(command, str):
+            match = self.hidden_query.search(command)
+            if match:
+                raise InvalidRequestError("Table %s does not exist." % match.group(1))
+        query = normalize_query(command) if isinstance(command, str) else None
+        if query is None or fetch == "cursor" or not READ_QUERY.match(query):
+            return super().run(command, fetch, include_columns, parameters=parameters,
+                               execution_options=execution_options)
+        query, notes = self.project_query(query)
+        key = (query, fetch, include_columns, repr(sorted((parameters or {}).items())))
+        result = self.cached_result(key)
+        if result is None:
+            rows = self._execute(self.capped(query), fetch, parameters=parameters,
+                                 execution_options=execution_options)
+            result = self.format_rows(rows, include_columns, notes)
+            self.store_result(key, result)
+        return result
+
+    def capped(self, query):
+        # One row past the cap tells whether rows were left out. A larger
+        # LIMIT of the query is lowered, so the database stops there too.
+        cap = self.max_rows + 1
+        match = TRAILING_LIMIT.search(query)
+        if match is None:
+            return "%s LIMIT %d" % (query, cap)
+        count = 2 if match.group(2) else 1
+        if int(match.group(count)) <= cap:
+            return query
+        return query[:match.start(count)] + str(cap) + query[match.end(count):]
+
+    def project_query(self, query):
+        match = SELECT_STAR.match(query)
+        if not match or match.group(2).lower() not in self.narrow_columns:
+            return query, []
+        columns, wide = self.narrow_columns[match.group(2).lower()]
+        quote = self._engine.dialect.identifier_preparer.quote
+        query = "SELECT %s FROM %s%s%s%s" % (", ".join(quote(c) for c in columns), match.group(1),
+                                             match.group(2), match.group(1), match.group(3))
+        return query, ["Long text columns (%s) were left out; select them by name if needed." % ", ".join(wide)]
+
+    def format_rows(self, rows, include_columns, notes):
+        if len(rows) > self.max_rows:
+            notes = notes + ["Only the first %d rows are shown; add filters or a LIMIT to narrow the query."
+                             % self.max_rows]
+            rows = rows[:self.max_rows]
+        rows = [{column: truncate_word(value, length=self._max_string_length) for column, value in row.items()}
+                for row in rows]
+        if not include_columns:
+            rows = [tuple(row.values()) for row in rows]
+        result = str(rows) if rows else ""
+        if len(result) > self.max_result_chars:
+            while rows and len(str(rows)) > self.max_result_chars:
+                rows = rows[:len(rows) * self.max_result_chars // len(str(rows))]
+            notes = notes + ["The result was cut to %d rows to fit in %d characters." % (len(rows),
+                                                                                      self.max_result_chars)]
+            result = str(rows)
+        return "\n".join([result] + ["(%s)" % note for note in notes]) if notes else result
+
+    def cached_result(self, key):
+        self.check_data_version()
+        with self._lock:
+            entry = self._results.get(key)
+            if entry is None or time.monotonic() - entry[1] >= self.result_ttl:
+                return None
+            self._results.move_to_end(key)
+            return entry[0]
+
+    def store_result(self, key, result):
+        if self.result_cache_size <= 0:
+            return
+        with self._lock:
+            self._results[key] = (result, time.monotonic())
+            self._results.move_to_end(key)
+            while len(self._results) > self.result_cache_size:
+                self._results.popitem(last=False)
+
+    def check_data_version(self):
+        if time.monotonic() - self._version_checked_at < self.data_check_interval:
+            return
+        self._version_checked_at = time.monotonic()
+        version = self.data_version()
+        if version != self.version:
+            self.version = version
+            with self._lock:
+                self._results.clear()
+
+    def get_table_info(self, table_names=None):
+        key = tuple(sorted(table_names)) if table_names else None
+        info = self._table_info.get(key)
+        if info is None:
+            info = super().get_table_info(table_names)
+            self._table_info[key] = info
+        return info
+
+    def visible_tables(self, query):
+        # Leaves the hidden tables out of an information_schema query.
+        if not self.hidden_tables:
+            return text(query)
+        return text(query + " AND table_name NOT IN :hidden").bindparams(
+            bindparam("hidden", self.hidden_tables, expanding=True))
+
+    def schema_checksum(self):
+        # One cheap query, instead of reflecting every table.
+        with self._engine.connect() as connection:
+            if self.dialect in ("mysql", "mariadb"):
+                return tuple(connection.execute(self.visible_tables(
+                    "SELECT COUNT(*), COALESCE(SUM(CRC32(CONCAT_WS(':', table_name, column_name, column_type, "
+                    "ordinal_position))), 0) FROM information_schema.columns "
+                    "WHERE table_schema = DATABASE()")).one())
+            if self.dialect == "sqlite":
+                return connection.execute(text("PRAGMA schema_version")).scalar()
+        inspector = inspect(self._engine)
+        columns = [(table, column["name"], str(column["type"]))
+                   for table in sorted(inspector.get_table_names(schema=self._schema))
+                   for column in inspector.get_columns(table, schema=self._schema)]
+        return hashlib.sha256(repr(columns).encode("utf-8")).hexdigest()
+
+    def data_version(self):
+        # Changes whenever a table is written to; None when the database
+        # cannot tell cheaply. SQLite only tells by the file, hidden tables
+        # included.
+        if self.dialect == "sqlite":
+            path = self._engine.url.database
+            return os.stat(path).st_mtime_ns if path and os.path.exists(path) else None
+        if self.dialect not in ("mysql", "mariadb"):
+            return None
+        with self._engine.connect() as connection:
+            try:
+                # MySQL 8 otherwise serves UPDATE_TIME from a day-long cache.
+                connection.execute(text("SET SESSION information_schema_stats_expiry = 0"))
+            except DBAPIError:
+                connection.rollback()
+            return tuple(connection.execute(self.visible_tables(
+                "SELECT COUNT(*), MAX(update_time) FROM information_schema.tables "
+                "WHERE table_schema = DATABASE()")).one())
+
+    def schema_changed(self):
+        # Checked at most once per interval; the first caller after a change
+        # sees True and should rebuild whatever was derived from this schema.
+        with self._lock:
+            if time.monotonic() - self._checked_at < self.schema_check_interval:
+                return False
+            self._checked_at = time.monotonic()
+            checksum = self.schema_checksum()
+            if checksum == self.checksum:
+                return False
+            self.checksum = checksum
+            return True
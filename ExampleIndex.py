@@ -0,0 +1,90 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from langchain_core.example_selectors import BaseExampleSelector
+
+import ArrayStore
+
+
+class ExampleIndex(BaseExampleSelector):
+    # Selects the k examples most similar to the input by cosine similarity,
+    # like SemanticSimilarityExampleSelector, but over vectors kept in a local
+    # file, so only the user's input is embedded per request.
+    # The prompt is formatted once per agent step, so the vectors of the last
+    # ``query_cache_size`` inputs are kept for the steps after the first.
+    def __init__(self, examples, embeddings, path=None, k=5, input_keys=("input",), query_cache_size=64):
+        self.examples = [dict(example) for example in examples]
+        self.embeddings = embeddings
+        self.path = path
+        self.k = k
+        self.input_keys = list(input_keys)
+        self.key = self.index_key()
+        self.query_cache_size = query_cache_size
+        self._queries = OrderedDict()
+        self._lock = threading.Lock()
+        self.vectors = self.load()
+        if self.vectors is None:
+            self.vectors = self.normalized(self.embeddings.embed_documents([self.text(e) for e in self.examples]))
+            if self.path:
+                ArrayStore.save_arrays(self.path, {"vectors": self.vectors}, {"key": self.key})
+
+    def index_key(self):
+        # Changing an example or the embedding model invalidates the file.
+        model = getattr(self.embeddings, "model", None) or getattr(self.embeddings, "model_name", None)
+        source = json.dumps({"examples": self.examples, "input_keys": self.input_keys,
+                             "embeddings": type(self.embeddings).__name__, "model": model},
+                            sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(source.encode("utf-8")).hexdigest()
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return None
+        try:
+            arrays, meta = ArrayStore.load_arrays(self.path)
+        except (OSError, ValueError, KeyError) as e:
+            print("Cannot load example index %s: %s" % (self.path, e))
+            return None
+        if meta.get("key") != self.key or len(arrays["vectors"]) != len(self.examples):
+            return None
+        return np.asarray(arrays["vectors"])
+
+    def text(self, values):
+        return " ".join(values[key] for key in sorted(self.input_keys))
+
+    @staticmethod
+    def normalized(vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+        return vectors / np.where(norms > 0, norms, 1)
+
+    def add_example(self, example):
+        vector = self.normalized([self.embeddings.embed_query(self.text(example))])
+        self.examples.append(dict(example))
+        self.vectors = np.vstack([self.vectors, vector])
+
+    def embed(self, text):
+        with self._lock:
+            vector = self._queries.get(text)
+            if vector is not None:
+                self._queries.move_to_end(text)
+                return vector
+        vector = self.normalized(self.embeddings.embed_query(text))
+        with self._lock:
+            self._queries[text] = vector
+            while len(self._queries) > self.query_cache_size:
+                self._queries.popitem(last=False)
+        return vector
+
+    def select_examples(self, input_variables):
+        query = self.embed(self.text(input_variables))
+        scores = self.vectors @ query
+        k = min(self.k, len(scores))
+        if k <= 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.lexsort((top, -scores[top]))]
+        return [dict(self.examples[i]) for i in top]
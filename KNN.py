@@ -1,56 +1,716 @@
+import copy
+import os
+import threading
+import time
+
+import numpy as np
 import pandas as pd
-from surprise import Reader, Dataset, accuracy, KNNBasic
-from sqlalchemy import create_engine
+import scipy.sparse as sp
+from sqlalchemy import text
 
+import ArrayStore
+import Concurrency
+import Database
+import Metrics
+from RecommendationTable import RecommendationTable
 
-class KNN:
-    def __init__(self, db_url):
-        self.db = create_engine(db_url)
-        self.df = None
-        self.knn = None
-        self.products = None
 
-    def load_data_and_train(self):
-        review_query = "SELECT * FROM review"
-        product_query = "SELECT * FROM product"
-        reviews = pd.read_sql(review_query, self.db)
-        products = pd.read_sql(product_query, self.db)
-
-        products.rename(columns={"id": "product_id", "rating": "avg_rating", "created_at": "cre_at"}, inplace=True)
-        merge = pd.merge(reviews, products, on="product_id", how="left")
-        df = merge.iloc[:, 0:8]
-        df = df[df.parent_id.isnull()].drop(["id", "comment", "created_at", "parent_id"], axis=1)
-        reader = Reader(rating_scale=(1, 5))
-        data = Dataset.load_from_df(df[["user_id", "product_id", "rating"]], reader=reader)
-        train_df = data.build_full_trainset()
-        self.knn = KNNBasic(k=5, sim_options={"name": "cosine", "user_based": True})
-        self.knn.fit(train_df)
-        self.products = products
-        self.df = df
+class KNNModel:
+    k = 5
+    # Neighbours kept per product in the item-to-item index.
+    similar_k = 20
+    # Upper bound on the entries a scoring step builds: its (users x
+    # products) block plus the neighbour ratings expanded into it.
+    score_block = 1 << 20
+    batch_rows = 4096
+    rating_scale = (1, 5)
+    # The cold-start ranking pulls each product's mean rating towards the
+    # global mean with the weight of this many reviews, then adds up to
+    # ``popularity_sold_weight`` stars for units sold (log scaled).
+    popularity_damping = 5
+    popularity_sold_weight = 1.0
+    # Everything a snapshot stores; the two sparse matrices are saved as
+    # their CSR arrays.
+    snapshot_format = 4
+    snapshot_meta = ("version", "trained_at", "high_water_mark", "review_count", "rating_sum", "review_hash",
+                     "trained_review_count", "global_mean")
+    snapshot_arrays = ("user_ids", "product_ids", "user_order", "sorted_user_ids", "product_order",
+                       "sorted_product_ids", "rating_order", "product_rating_sum", "product_rating_count",
+                       "popular", "similar_indptr", "similar_products", "similar_scores")
+    snapshot_matrices = ("ratings", "sim")
+
+    def __init__(self, df, version, sales=None):
+        self.version = version
+        self.trained_at = time.time()
+        # Incremental updates read reviews above the high-water mark; the
+        # count and hash sum of the reviews below it reveal edits and
+        # deletions, which need a full retrain.
+        self.high_water_mark = int(df["id"].max()) if len(df) else 0
+        self.review_count = len(df)
+        self.rating_sum = int(df["rating"].sum())
+        self.review_hash = review_hash(df)
+        self.trained_review_count = len(df)
+
+        # Like KNNBasic, every review counts, a user's repeated reviews of the
+        # same product included.
+        user_codes, user_ids = pd.factorize(df["user_id"])
+        product_codes, product_ids = pd.factorize(df["product_id"])
+        self.user_ids = np.asarray(user_ids, dtype=np.int64)
+        self.product_ids = np.asarray(product_ids, dtype=np.int64)
+        self.index_ids()
+        self.ratings, self.rating_order = self.rating_matrix(
+            user_codes, product_codes, df["rating"].to_numpy(np.float64), np.arange(len(df)),
+            (len(self.user_ids), len(self.product_ids)))
+        self.global_mean = self.ratings.data.mean() if self.ratings.nnz else sum(self.rating_scale) / 2
+        self.product_rating_sum = np.zeros(len(self.product_ids))
+        self.product_rating_count = np.zeros(len(self.product_ids), dtype=np.int64)
+        self.add_product_ratings(df)
+        self.rank_popular(sales)
+        self.sim = self.cosine_similarity(self.ratings)
+        self.similar_indptr, self.similar_products, self.similar_scores = self.item_neighbours(
+            self.ratings, self.product_ids, self.similar_k)
+
+    def index_ids(self):
+        # Sorted copies of the id arrays, binary searched to map ids to rows.
+        self.user_order = np.argsort(self.user_ids, kind="stable")
+        self.sorted_user_ids = self.user_ids[self.user_order]
+        self.product_order = np.argsort(self.product_ids, kind="stable")
+        self.sorted_product_ids = self.product_ids[self.product_order]
+
+    @staticmethod
+    def find_rows(sorted_ids, order, ids):
+        ids = np.asarray(ids, dtype=np.int64)
+        if len(sorted_ids) == 0:
+            return np.full(ids.shape, -1)
+        positions = np.minimum(np.searchsorted(sorted_ids, ids), len(sorted_ids) - 1)
+        return np.where(sorted_ids[positions] == ids, order[positions], -1)
+
+    def user_rows(self, user_ids):
+        return self.find_rows(self.sorted_user_ids, self.user_order, user_ids)
+
+    def product_rows(self, product_ids):
+        return self.find_rows(self.sorted_product_ids, self.product_order, product_ids)
+
+    def add_product_ratings(self, reviews):
+        rows = self.product_rows(reviews["product_id"].to_numpy())
+        self.product_rating_sum += np.bincount(rows, weights=reviews["rating"].to_numpy(np.float64),
+                                               minlength=len(self.product_ids))
+        self.product_rating_count += np.bincount(rows, minlength=len(self.product_ids))
+
+    def rank_popular(self, sales=None):
+        # Ranked once per model over every reviewed or sold product, so a
+        # single 5-star review no longer outranks a well reviewed bestseller.
+        if sales is None:
+            sales = pd.DataFrame({"product_id": [], "sold": []})
+        product_ids = np.union1d(self.product_ids, sales["product_id"].to_numpy(np.int64))
+        reviewed = np.searchsorted(product_ids, self.product_ids)
+        total = np.zeros(len(product_ids))
+        count = np.zeros(len(product_ids))
+        total[reviewed] = self.product_rating_sum
+        count[reviewed] = self.product_rating_count
+        prior = self.rating_sum / self.review_count if self.review_count else sum(self.rating_scale) / 2
+        score = (prior * self.popularity_damping + total) / (self.popularity_damping + count)
+
+        sold = np.zeros(len(product_ids))
+        sold[np.searchsorted(product_ids, sales["product_id"].to_numpy(np.int64))] = \
+            sales["sold"].fillna(0).clip(lower=0).to_numpy(np.float64)
+        if sold.max(initial=0) > 0:
+            score += self.popularity_sold_weight * np.log1p(sold) / np.log1p(sold.max())
+        self.popular = product_ids[np.lexsort((product_ids, -score))]
+
+    @staticmethod
+    def rating_matrix(users, products, values, order, shape):
+        # One entry per review, so a repeated (user, product) is a duplicate
+        # entry rather than a sum; entries are sorted by product and then by
+        # load order, which KNNBasic uses to break ties between neighbours.
+        # Matrix products add duplicates up, as surprise's sums do, but
+        # element-wise operations would merge them: use ``cells`` instead.
+        entries = np.lexsort((order, products, users))
+        indptr = np.zeros(shape[0] + 1, dtype=np.int64)
+        np.cumsum(np.bincount(users, minlength=shape[0]), out=indptr[1:])
+        ratings = sp.csr_matrix((values[entries], products[entries], indptr), shape=shape)
+        ratings.has_sorted_indices = True
+        return ratings, order[entries]
+
+    @staticmethod
+    def cells(ratings, values):
+        # One entry per rated (user, product), holding the sum of ``values``
+        # over its reviews.
+        cells = sp.csr_matrix((values.copy(), ratings.indices.copy(), ratings.indptr.copy()), shape=ratings.shape)
+        cells.sum_duplicates()
+        return cells
+
+    @staticmethod
+    def cosine_similarity(ratings, rows=None):
+        # Same definition as surprise's cosine: every sum runs over the items
+        # both users rated, not over the full rating vectors. Returns the
+        # similarity of the users at ``rows`` (all users by default) to
+        # every user.
+        # With repeated reviews, surprise adds up every pair of the two
+        # users' ratings of an item: products of the entry matrices do too.
+        # Own index arrays, so nothing done to these can reach ``ratings``.
+        rated = sp.csr_matrix((np.ones_like(ratings.data), ratings.indices.copy(), ratings.indptr.copy()),
+                              shape=ratings.shape)
+        squares = sp.csr_matrix((ratings.data ** 2, ratings.indices.copy(), ratings.indptr.copy()),
+                                shape=ratings.shape)
+        if rows is None:
+            rows = np.arange(ratings.shape[0])
+            prods, sqi, sqj = ratings @ ratings.T, squares @ rated.T, rated @ squares.T
+        else:
+            prods, sqi, sqj = ratings[rows] @ ratings.T, squares[rows] @ rated.T, rated[rows] @ squares.T
+        # Ratings are positive, so all three share the co-rating pattern.
+        for m in (prods, sqi, sqj):
+            m.sort_indices()
+        sim = prods
+        sim.data = prods.data / np.sqrt(sqi.data * sqj.data)
+        sim.data[sim.indices == np.repeat(rows, np.diff(sim.indptr))] = 0
+        sim.eliminate_zeros()
+        return sim
+
+    @staticmethod
+    def item_neighbours(ratings, product_ids, k):
+        # Top-k products by cosine similarity of their rating columns, kept
+        # as CSR-style arrays: the neighbours of product row i are
+        # products[indptr[i]:indptr[i + 1]], best first.
+        ratings = KNNModel.cells(ratings, ratings.data)
+        norms = np.sqrt(np.asarray(ratings.multiply(ratings).sum(axis=0))).ravel()
+        normalized = (ratings @ sp.diags(1 / np.maximum(norms, 1e-12))).tocsc()
+        sim = (normalized.T @ normalized).tocoo()
+        off_diagonal = sim.row != sim.col
+        rows, cols, scores = sim.row[off_diagonal], sim.col[off_diagonal], sim.data[off_diagonal]
+        order = np.lexsort((product_ids[cols], -np.round(scores, 12), rows))
+        rows, cols, scores = rows[order], cols[order], scores[order]
+        counts = np.bincount(rows, minlength=len(product_ids))
+        rank = np.arange(len(rows)) - np.repeat(np.cumsum(counts) - counts, counts)
+        top = rank < k
+        indptr = np.zeros(len(product_ids) + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum(np.minimum(counts, k))
+        return indptr, product_ids[cols[top]].astype(np.int32), scores[top].astype(np.float32)
+
+    def updated(self, reviews, version, sales=None):
+        # A new model sharing nothing mutable with this one: readers of the
+        # current model are unaffected until the new one is swapped in.
+        model = copy.copy(self)
+        model.version = version
+        model.trained_at = time.time()
+        model.high_water_mark = int(reviews["id"].max())
+        model.review_count = self.review_count + len(reviews)
+        model.rating_sum = self.rating_sum + int(reviews["rating"].sum())
+        model.review_hash = self.review_hash + review_hash(reviews)
+
+        new_users = pd.unique(reviews["user_id"][self.user_rows(reviews["user_id"].to_numpy()) < 0])
+        new_products = pd.unique(reviews["product_id"][self.product_rows(reviews["product_id"].to_numpy()) < 0])
+        model.user_ids = np.concatenate([self.user_ids, new_users])
+        model.product_ids = np.concatenate([self.product_ids, new_products])
+        model.index_ids()
+        model.product_rating_sum = np.r_[self.product_rating_sum, np.zeros(len(new_products))]
+        model.product_rating_count = np.r_[self.product_rating_count, np.zeros(len(new_products), dtype=np.int64)]
+        model.add_product_ratings(reviews)
+        model.rank_popular(sales)
+
+        user_codes = model.user_rows(reviews["user_id"].to_numpy())
+        product_codes = model.product_rows(reviews["product_id"].to_numpy())
+        shape = (len(model.user_ids), len(model.product_ids))
+
+        # New reviews are added next to the old ones, a repeated review of a
+        # product included, as a full training would.
+        old = self.ratings.tocoo()
+        model.ratings, model.rating_order = self.rating_matrix(
+            np.concatenate([old.row, user_codes]),
+            np.concatenate([old.col, product_codes]),
+            np.concatenate([old.data, reviews["rating"].to_numpy(np.float64)]),
+            np.concatenate([self.rating_order, self.rating_order.max(initial=-1) + 1 + np.arange(len(reviews))]),
+            shape)
+        model.global_mean = model.ratings.data.mean()
+
+        # Only the similarities of users with new ratings change: recompute
+        # their rows and columns and keep everything else.
+        changed = np.unique(user_codes)
+        n_users = shape[0]
+        sim = sp.csr_matrix((self.sim.data, self.sim.indices,
+                             np.r_[self.sim.indptr, np.full(n_users - self.sim.shape[0], self.sim.nnz)]),
+                            shape=(n_users, n_users))
+        keep = np.ones(n_users)
+        keep[changed] = 0
+        keep = sp.diags(keep)
+        fresh = self.cosine_similarity(model.ratings, changed).tocoo()
+        fresh = sp.csr_matrix((fresh.data, (changed[fresh.row], fresh.col)), shape=(n_users, n_users))
+        model.sim = (keep @ sim @ keep + fresh + keep @ fresh.T).tocsr()
+        model.sim.eliminate_zeros()
+        model.sim.sort_indices()
+        model.similar_indptr, model.similar_products, model.similar_scores = self.item_neighbours(
+            model.ratings, model.product_ids, self.similar_k)
+        return model
+
+    def save(self, path):
+        arrays = {name: getattr(self, name) for name in self.snapshot_arrays}
+        for name in self.snapshot_matrices:
+            matrix = getattr(self, name)
+            arrays[name + "_indptr"] = matrix.indptr
+            arrays[name + "_indices"] = matrix.indices
+            arrays[name + "_data"] = matrix.data
+        meta = {name: getattr(self, name) for name in self.snapshot_meta}
+        meta["format"] = self.snapshot_format
+        ArrayStore.save_arrays(path, arrays, meta)
+
+    @classmethod
+    def load(cls, path):
+        # Every array stays a read-only memory map of the snapshot file, so
+        # processes loading the same snapshot share its pages.
+        arrays, meta = ArrayStore.load_arrays(path)
+        if meta.get("format") != cls.snapshot_format:
+            raise ValueError("%s has snapshot format %s, expected %s" % (path, meta.get("format"),
+                                                                          cls.snapshot_format))
+        model = cls.__new__(cls)
+        for name in cls.snapshot_meta:
+            setattr(model, name, meta[name])
+        for name in cls.snapshot_arrays:
+            setattr(model, name, arrays[name])
+        shapes = {"ratings": (len(model.user_ids), len(model.product_ids)),
+                  "sim": (len(model.user_ids), len(model.user_ids))}
+        for name in cls.snapshot_matrices:
+            matrix = sp.csr_matrix((arrays[name + "_data"], arrays[name + "_indices"], arrays[name + "_indptr"]),
+                                   shape=shapes[name], copy=False)
+            setattr(model, name, matrix)
+        return model
+
+    # Estimated rating of every product for the users at ``rows``, computed
+    # like KNNBasic(k=5, cosine, user_based): the similarity-weighted mean
+    # rating of the k most similar users who rated the product, falling back
+    # to the global mean.
+    def estimate(self, rows, observe=False):
+        n_products = len(self.product_ids)
+        sim = self.sim[rows].tocoo()
+        positive = sim.data > 0
+        batch, neighbours, weights = sim.row[positive], sim.col[positive], sim.data[positive]
+        # Most similar neighbours first; this sorts pairs, not ratings.
+        pairs = np.lexsort((-weights, batch))
+        batch, neighbours, weights = batch[pairs], neighbours[pairs], weights[pairs]
+
+        # Expand every (user, neighbour) pair into the neighbour's ratings.
+        starts = self.ratings.indptr[neighbours]
+        counts = self.ratings.indptr[neighbours + 1] - starts
+        entries = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        weights = np.repeat(weights, counts)
+        cells = np.repeat(batch.astype(np.int64) * n_products, counts) + self.ratings.indices[entries]
+
+        # Keep the k most similar neighbours for each (user, product) cell.
+        # Non-positive similarities never contribute to KNNBasic's estimate,
+        # so they were dropped above without changing the result. Ratings are
+        # already grouped by user, so a stable sort of each user's products
+        # orders the cells and keeps their ratings most similar first; numpy
+        # radix sorts 16-bit keys, which most catalogs fit in.
+        products = self.ratings.indices[entries].astype(np.uint16 if n_products <= 1 << 16 else np.int32)
+        bounds = np.searchsorted(batch, np.arange(len(rows) + 1))
+        bounds = np.r_[0, np.cumsum(counts)][bounds]
+        order = np.concatenate([start + np.argsort(products[start:end], kind="stable")
+                                for start, end in zip(bounds[:-1], bounds[1:])] or [np.zeros(0, np.int64)])
+        cells, entries, weights = cells[order], entries[order], weights[order]
+        group_starts = np.flatnonzero(np.r_[True, cells[1:] != cells[:-1]])
+        group_sizes = np.diff(np.r_[group_starts, len(cells)])
+        position = np.arange(len(cells)) - np.repeat(group_starts, group_sizes)
+        nearest = position < self.k
+        self.break_ties(nearest, position, group_starts, group_sizes, weights, entries)
+        cells, weights, values = cells[nearest], weights[nearest], self.ratings.data[entries[nearest]]
+
+        size = len(rows) * n_products
+        numerator = np.bincount(cells, weights=weights * values, minlength=size)
+        denominator = np.bincount(cells, weights=weights, minlength=size)
+        est = np.full(size, self.global_mean)
+        reached = denominator > 0
+        np.divide(numerator, denominator, out=est, where=reached)
+        if observe:
+            for candidates in np.count_nonzero(reached.reshape(len(rows), n_products), axis=1):
+                Metrics.CANDIDATES.observe(candidates)
+        np.clip(est, *self.rating_scale, out=est)
+        return est.reshape(len(rows), n_products)
+
+    @staticmethod
+    def bisect(weights, lo, hi, target, below):
+        # For every range [lo, hi) of non-increasing weights, the first
+        # position whose weight is below the target, or at most it when
+        # ``below`` is False.
+        lo, hi = lo.copy(), hi.copy()
+        while True:
+            active = lo < hi
+            if not active.any():
+                return lo
+            mid = (lo + hi) // 2
+            weight = weights[np.where(active, mid, 0)]
+            right = active & ((weight >= target) if below else (weight > target))
+            lo = np.where(right, mid + 1, lo)
+            hi = np.where(active & ~right, mid, hi)
+
+    def break_ties(self, nearest, position, group_starts, group_sizes, weights, entries):
+        # Within a cell, neighbours as similar as the k-th one are in no
+        # particular order; where some of them fall past k, KNNBasic takes
+        # those loaded first. Only these boundary ties are sorted again.
+        groups = np.flatnonzero(group_sizes > self.k)
+        cut = group_starts[groups] + self.k
+        tied = weights[cut - 1] == weights[cut]
+        if not tied.any():
+            return
+        groups, cut = groups[tied], cut[tied]
+        target = weights[cut]
+        starts = self.bisect(weights, group_starts[groups], cut, target, below=False)
+        ends = self.bisect(weights, cut, group_starts[groups] + group_sizes[groups], target, below=True)
+        sizes = ends - starts
+        tie = np.repeat(starts - np.cumsum(sizes) + sizes, sizes) + np.arange(sizes.sum())
+        group = np.repeat(np.arange(len(cut)), sizes)
+        # The places the more similar ratings left go to the tie.
+        need = self.k - position[starts]
+        # Load orders are below the number of ratings, so one int64 key
+        # sorts by group, then load order, faster than lexsort's two keys.
+        tie = tie[np.argsort(group * len(self.rating_order) + self.rating_order[entries[tie]])]
+        rank = np.arange(len(tie)) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+        nearest[tie] = rank < need[group]
+
+    def top_n(self, rows, n, observe=False):
+        # ``observe`` records metrics for request-time scoring; table builds
+        # are timed as a whole instead.
+        n = min(n, len(self.product_ids))
+        if n <= 0:
+            return [[] for _ in rows]
+        if not observe:
+            return self.rank(rows, self.estimate(rows), n)
+        with Metrics.stage("score"):
+            est = self.estimate(rows, observe)
+        with Metrics.stage("rank"):
+            return self.rank(rows, est, n)
+
+    def rank(self, rows, est, n):
+        est[self.ratings[rows].nonzero()] = -np.inf
+        # The n-th best score of each row, then an ordered pick among the
+        # products reaching it; ties go to the lower product id, so a shorter
+        # list is a prefix of a longer one.
+        thresholds = -np.partition(-est, n - 1, axis=1)[:, n - 1]
+        results = []
+        for scores, threshold in zip(est, thresholds):
+            candidates = np.flatnonzero((scores >= threshold) & (scores > -np.inf))
+            top = candidates[np.lexsort((self.product_ids[candidates], -scores[candidates]))[:n]]
+            results.append(self.product_ids[top].tolist())
+        return results
+
+    def row_blocks(self, rows):
+        # A block's cost is its dense estimate plus the neighbour ratings it
+        # expands into, which grows with neighbours, not with rows.
+        ratings_per_user = np.diff(self.ratings.indptr)
+        for start in range(0, len(rows), self.batch_rows):
+            chunk = rows[start:start + self.batch_rows]
+            cost = (self.sim[chunk] > 0) @ ratings_per_user + len(self.product_ids)
+            blocks = np.cumsum(cost) // self.score_block
+            yield from np.split(chunk, np.flatnonzero(np.diff(blocks)) + 1)
+
+    def iter_top_n(self, rows, n, observe=False):
+        for block in self.row_blocks(rows):
+            yield from self.top_n(block, n, observe)
+
+    def iter_recommendation_blocks(self, user_ids, n=10):
+        # Yields (user_id, products) pairs a scoring block at a time, so the
+        # caller can run every block on a worker of its own.
+        cold_start = [int(p) for p in self.get_top_rated_products(n)]
+        for start in range(0, len(user_ids), self.batch_rows):
+            chunk = user_ids[start:start + self.batch_rows]
+            rows = self.user_rows(chunk)
+            known = np.flatnonzero(rows >= 0)
+            Metrics.MODEL_LOOKUPS.inc(len(known))
+            Metrics.COLD_START_LOOKUPS.inc(len(rows) - len(known))
+            results = [cold_start] * len(chunk)
+            done = begin = 0
+            for block in (self.row_blocks(rows[known]) if len(known) else ()):
+                for position, products in zip(known[done:done + len(block)], self.top_n(block, n, observe=True)):
+                    results[position] = products or cold_start
+                done += len(block)
+                # Cold starts up to the next scored user go out with this block.
+                end = known[done] if done < len(known) else len(chunk)
+                yield list(zip(chunk[begin:end], results[begin:end]))
+                begin = end
+            if begin < len(chunk):
+                yield list(zip(chunk[begin:], results[begin:]))
+
+    def get_similar_products(self, product_id: int, n: int = 10):
+        row = self.product_rows(product_id)
+        if row < 0:
+            return []
+        start, end = self.similar_indptr[row], self.similar_indptr[row + 1]
+        return self.similar_products[start:min(end, start + n)].tolist()
 
     def get_top_rated_products(self, n):
-        top_rated_products = self.df.groupby("product_id")["rating"].mean().sort_values(ascending=False)
-        top_rated_product_ids = top_rated_products.index.values[:n]
-        return top_rated_product_ids
+        return self.popular[:max(n, 0)].tolist()
 
     def get_recommendations(self, user_id: int, n: int = 10):
-        self.load_data_and_train()
-        top_n_recommendations = []
-        if user_id not in self.df["user_id"].unique():
+        row = self.user_rows(user_id)
+        if row < 0:
+            Metrics.COLD_START_LOOKUPS.inc()
+            return self.get_top_rated_products(n)
+        Metrics.MODEL_LOOKUPS.inc()
+        top_n_product_ids = self.top_n(np.array([row]), n, observe=True)[0]
+        if not top_n_product_ids:
             top_n_product_ids = self.get_top_rated_products(n)
-        else:
-            user_products = self.df.query("user_id == @user_id")["product_id"].unique()
-            all_products = self.df["product_id"].unique()
-            products_to_predict = list(set(all_products) - set(user_products))
-            user_product_ratings = [(user_id, product_id, 3) for product_id in products_to_predict]
-            products_predict = self.knn.test(user_product_ratings)
-            top_n_recommendations = sorted(products_predict, key=lambda x: x.est, reverse=True)[:n]
-            top_n_product_ids = [int(pred.iid) for pred in top_n_recommendations]
-
-            if not top_n_product_ids:
-                top_n_product_ids = self.get_top_rated_products(n)
-
-        product_names = self.products[self.products["product_id"].isin(top_n_product_ids)]["name"].tolist()
-        for p, t in zip(product_names, top_n_recommendations):
-            print(u"%s voi predict la: %s" % (p.encode("utf-8", "replace"), t.est))
         return top_n_product_ids
+
+
+# Only top-level reviews carry a rating; replies have a parent_id.
+RATED_REVIEWS = ("parent_id IS NULL AND user_id IS NOT NULL AND product_id IS NOT NULL "
+                 "AND rating IS NOT NULL")
+RATING_DTYPES = {"id": np.int32, "user_id": np.int32, "product_id": np.int32, "rating": np.int8}
+
+
+def load_ratings(db, high_water_mark=0, chunksize=100000):
+    # Only the rating triples are read, streamed from a server-side cursor
+    # in chunks of compact dtypes, so memory follows the number of ratings
+    # rather than the size of review comments or product descriptions.
+    query = text("SELECT id, user_id, product_id, rating FROM review "
+                 "WHERE " + RATED_REVIEWS + " AND id > :high_water_mark ORDER BY id")
+    with db.connect().execution_options(stream_results=True) as connection:
+        chunks = list(pd.read_sql(query, connection, params={"high_water_mark": high_water_mark},
+                                  chunksize=chunksize, dtype=RATING_DTYPES))
+    if not chunks:
+        return pd.DataFrame({name: pd.Series(dtype=dtype) for name, dtype in RATING_DTYPES.items()})
+    return pd.concat(chunks, ignore_index=True)
+
+
+def load_sales(db):
+    query = "SELECT id AS product_id, COALESCE(sold, 0) AS sold FROM product"
+    return pd.read_sql(query, db, dtype={"product_id": np.int32, "sold": np.int32})
+
+
+# A hash of every review row, summed: any edit of a row changes its term, and
+# unlike a rating sum, two edits rarely cancel out. The arithmetic stays in
+# 64-bit integers, so MySQL, SQLite and numpy agree on it.
+REVIEW_HASH_MODULUS = 2147483647
+REVIEW_HASH = ("(id * 7919 + user_id * 104729 + product_id * 1299709) %% %d * (rating + 31) %% %d"
+               % (REVIEW_HASH_MODULUS, REVIEW_HASH_MODULUS))
+
+
+def review_hash(df):
+    columns = [df[name].to_numpy(np.int64) for name in ("id", "user_id", "product_id", "rating")]
+    ids, user_ids, product_ids, ratings = columns
+    key = (ids * 7919 + user_ids * 104729 + product_ids * 1299709) % REVIEW_HASH_MODULUS
+    return int((key * (ratings + 31) % REVIEW_HASH_MODULUS).sum())
+
+
+def review_checksum(db, high_water_mark):
+    query = text("SELECT COUNT(*), COALESCE(SUM(" + REVIEW_HASH + "), 0) FROM review "
+                 "WHERE " + RATED_REVIEWS + " AND id <= :high_water_mark")
+    with db.connect() as connection:
+        count, total = connection.execute(query, {"high_water_mark": high_water_mark}).one()
+    return int(count), int(total)
+
+
+def train_model(db, version, table_path=None, table_size=10, snapshot_path=None):
+    # ``db`` is a database URL when called in a worker process. Returns the
+    # model and the duration of every stage, for the caller to observe.
+    if isinstance(db, str):
+        db = Database.get_engine(db)
+    durations = {}
+    with Metrics.stage("load_ratings", durations):
+        ratings = load_ratings(db)
+    with Metrics.stage("load_sales", durations):
+        sales = load_sales(db)
+    with Metrics.stage("fit", durations):
+        model = KNNModel(ratings, version, sales)
+    if table_path:
+        with Metrics.stage("table_build", durations):
+            RecommendationTable.build(model, table_path, table_size)
+    if snapshot_path:
+        with Metrics.stage("snapshot_save", durations):
+            model.save(snapshot_path)
+        # The caller maps the snapshot rather than receiving a pickled copy.
+        return None, durations
+    return model, durations
+
+
+def update_model(db, model, reviews, version, table_path=None, table_size=10, snapshot_path=None,
+                 trained_at=None):
+    # Like train_model, for an incremental update. With a snapshot, ``model``
+    # is None and the worker maps the snapshot, which must still be the one
+    # trained at ``trained_at``.
+    if isinstance(db, str):
+        db = Database.get_engine(db)
+    durations = {}
+    if model is None:
+        with Metrics.stage("snapshot_load", durations):
+            model = KNNModel.load(snapshot_path)
+        if model.trained_at != trained_at:
+            raise ValueError("%s was replaced during the update" % snapshot_path)
+    with Metrics.stage("load_sales", durations):
+        sales = load_sales(db)
+    with Metrics.stage("incremental_fit", durations):
+        model = model.updated(reviews, version, sales)
+    if table_path:
+        with Metrics.stage("table_build", durations):
+            RecommendationTable.build(model, table_path, table_size)
+    if snapshot_path:
+        with Metrics.stage("snapshot_save", durations):
+            model.save(snapshot_path)
+        return None, durations
+    return model, durations
+
+
+class KNN:
+    def __init__(self, db_url, table_path=None, table_size=10, executor=None, drift_threshold=0.2,
+                 snapshot_path=None):
+        self.db_url = db_url
+        self.db = Database.get_engine(db_url)
+        self.executor = executor
+        # Fraction of reviews added since the last full training after which
+        # incremental updates give way to a full retrain.
+        self.drift_threshold = drift_threshold
+        self.model = None
+        self.table = None
+        self.table_path = table_path
+        self.table_size = table_size
+        self.snapshot_path = snapshot_path
+        self.version = 0
+        self._refresher = None
+        self._stop_refresher = threading.Event()
+        # A burst of requests finding no model, or the refresher at the same
+        # time, share one training; concurrent requests for the same user
+        # share one scoring.
+        self._flights = Concurrency.SingleFlight()
+
+    def load_data_and_train(self):
+        return self._flights.run("reload", self._train)
+
+    def update(self):
+        return self._flights.run("reload", self._update)
+
+    def _train(self):
+        version = self.version + 1
+        args = (version, self.table_path, self.table_size, self.snapshot_path)
+        with Metrics.stage("train"):
+            if self.executor is None:
+                model, durations = train_model(self.db, *args)
+            else:
+                # Training is CPU bound, so it runs in a worker process; the
+                # finished model is sent back and swapped in here.
+                model, durations = self.executor.submit(train_model, self.db_url, *args).result()
+        Metrics.observe_stages(durations)
+        if model is None:
+            with Metrics.stage("snapshot_load"):
+                model = KNNModel.load(self.snapshot_path)
+
+        # The new model is fully built before it replaces the served one, so
+        # concurrent readers only ever see a complete model.
+        self.version = version
+        self.model = model
+        Metrics.model_swapped(model)
+        if self.table_path:
+            self.table = RecommendationTable(self.table_path)
+        return model
+
+    def _update(self):
+        # Another worker may already have trained past this model.
+        self.load_snapshot()
+        model = self.model
+        if model is None:
+            return self._train()
+        with Metrics.stage("checksum"):
+            checksum = review_checksum(self.db, model.high_water_mark)
+        if checksum != (model.review_count, model.review_hash):
+            return self._train()
+        with Metrics.stage("load_new_ratings"):
+            reviews = load_ratings(self.db, model.high_water_mark)
+        if reviews.empty:
+            return model
+        if model.review_count + len(reviews) > model.trained_review_count * (1 + self.drift_threshold):
+            return self._train()
+
+        version = self.version + 1
+        args = (reviews, version, self.table_path, self.table_size, self.snapshot_path, model.trained_at)
+        with Metrics.stage("update"):
+            if self.executor is None:
+                model, durations = update_model(self.db, model, *args)
+            else:
+                # Like a full training, the update and the table build run in
+                # a worker process; a snapshot saves sending the model there.
+                current = None if self.snapshot_path else model
+                model, durations = self.executor.submit(update_model, self.db_url, current, *args).result()
+        Metrics.observe_stages(durations)
+        if model is None:
+            with Metrics.stage("snapshot_load"):
+                model = KNNModel.load(self.snapshot_path)
+        self.version = version
+        self.model = model
+        Metrics.model_swapped(model)
+        if self.table_path:
+            self.table = RecommendationTable(self.table_path)
+        return model
+
+    def load_snapshot(self):
+        if not self.snapshot_path or not os.path.exists(self.snapshot_path):
+            return None
+        try:
+            with Metrics.stage("snapshot_load"):
+                model = KNNModel.load(self.snapshot_path)
+        except (OSError, ValueError, KeyError) as e:
+            print("Cannot load KNN snapshot %s: %s" % (self.snapshot_path, e))
+            return None
+        current = self.model
+        if current is not None and model.trained_at <= current.trained_at:
+            return None
+        self.version = max(self.version, model.version)
+        self.model = model
+        Metrics.model_swapped(model)
+        self.open_table()
+        return model
+
+    def open_table(self):
+        if self.table_path and os.path.exists(self.table_path):
+            self.table = RecommendationTable(self.table_path)
+        return self.table
+
+    def start_refresher(self, interval):
+        if interval <= 0 or self._refresher is not None:
+            return
+        self._stop_refresher.clear()
+        self._refresher = threading.Thread(target=self._refresh_loop, args=(interval,),
+                                           name="knn-refresher", daemon=True)
+        self._refresher.start()
+
+    def stop_refresher(self):
+        if self._refresher is None:
+            return
+        self._stop_refresher.set()
+        self._refresher.join()
+        self._refresher = None
+
+    def _refresh_loop(self, interval):
+        while not self._stop_refresher.wait(interval):
+            try:
+                self.update()
+            except Exception as e:
+                print("KNN refresh failed, keeping model version %s: %s" % (self.version, e))
+
+    def get_top_rated_products(self, n):
+        return self.model.get_top_rated_products(n)
+
+    def iter_recommendation_blocks(self, user_ids, n=10):
+        # Every user in the batch is answered from the same table or model.
+        table = self.table
+        if table is not None and n <= table.n:
+            Metrics.TABLE_LOOKUPS.inc(len(user_ids))
+            size = KNNModel.batch_rows
+            return ([(user_id, table.lookup(user_id, n)) for user_id in user_ids[start:start + size]]
+                    for start in range(0, len(user_ids), size))
+        model = self.model
+        if model is None:
+            model = self.load_data_and_train()
+        return model.iter_recommendation_blocks(user_ids, n)
+
+    def get_similar_products(self, product_id: int, n: int = 10):
+        model = self.model
+        if model is None:
+            model = self.load_data_and_train()
+        return model.get_similar_products(product_id, n)
+
+    def get_recommendations(self, user_id: int, n: int = 10):
+        table = self.table
+        if table is not None and n <= table.n:
+            Metrics.TABLE_LOOKUPS.inc()
+            return table.lookup(user_id, n)
+        model = self.model
+        if model is None:
+            model = self.load_data_and_train()
+        return self._flights.run(("user", user_id, n, model.version), model.get_recommendations, user_id, n)
@@ -0,0 +1,207 @@
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from langchain.memory import ConversationSummaryBufferMemory, ConversationTokenBufferMemory
+from langchain_core.chat_history import BaseChatMessageHistory
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+from sqlalchemy import Column, Float, MetaData, String, Table, Text, delete, func, insert, select, update
+from sqlalchemy.exc import IntegrityError
+
+import Database
+
+MESSAGE_TYPES = {"human": HumanMessage, "ai": AIMessage, "system": SystemMessage}
+
+
+def dumps(messages, summary):
+    # Only each message's type and text are kept: [["human", "..."], ...].
+    history = {"messages": [[message.type, message.content] for message in messages]}
+    if summary:
+        history["summary"] = summary
+    return json.dumps(history, ensure_ascii=False, separators=(",", ":"))
+
+
+def loads(data):
+    history = json.loads(data)
+    messages = [MESSAGE_TYPES[kind](content=content) for kind, content in history["messages"]]
+    return messages, history.get("summary", "")
+
+
+class LocalSessionBackend:
+    # Sessions in this process only, least recently used first; enough for a
+    # single worker.
+    def __init__(self, max_sessions=10000, ttl=1800):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def load(self, session_id):
+        now = time.monotonic()
+        with self._lock:
+            self.evict_expired(now)
+            session = self.sessions.get(session_id)
+            if session is None:
+                return None
+            self.sessions.move_to_end(session_id)
+            return loads(session[0])
+
+    def save(self, session_id, messages, summary=""):
+        with self._lock:
+            self.sessions.pop(session_id, None)
+            self.sessions[session_id] = (dumps(messages, summary), time.monotonic())
+            while len(self.sessions) > self.max_sessions:
+                self.sessions.popitem(last=False)
+
+    def evict_expired(self, now):
+        # Oldest first, so this stops at the first session still in use.
+        while self.sessions:
+            data, last_used = next(iter(self.sessions.values()))
+            if now - last_used < self.ttl:
+                break
+            self.sessions.popitem(last=False)
+
+
+class SQLSessionBackend:
+    # Sessions in a database table shared by every worker and replica, e.g.
+    # sqlite:///chat_sessions.db locally or the MySQL database in production.
+    # Rows are keyed by a hash of the session id, so ids of any length fit.
+    # A save replaces the history: turns of one user are serialized within a
+    # process only, so two processes answering the same user at once keep
+    # the history of whichever saves last.
+    purge_interval = 60
+    table_name = "chat_session"
+
+    def __init__(self, db, ttl=1800, table_name=table_name):
+        self.db = Database.get_engine(db) if isinstance(db, str) else db
+        self.ttl = ttl
+        self.table = Table(table_name, MetaData(),
+                           Column("session_id", String(64), primary_key=True),
+                           Column("history", Text(16777215), nullable=False),
+                           Column("updated_at", Float, nullable=False, index=True))
+        self.table.create(self.db, checkfirst=True)
+        self._purged_at = 0
+
+    @staticmethod
+    def key(session_id):
+        return hashlib.sha256(session_id.encode("utf-8")).hexdigest()
+
+    def __len__(self):
+        with self.db.connect() as connection:
+            return connection.execute(select(func.count()).select_from(self.table).where(
+                self.table.c.updated_at >= time.time() - self.ttl)).scalar()
+
+    def load(self, session_id):
+        session_id = self.key(session_id)
+        with self.db.connect() as connection:
+            row = connection.execute(select(self.table.c.history, self.table.c.updated_at).where(
+                self.table.c.session_id == session_id)).first()
+        if row is None or row.updated_at < time.time() - self.ttl:
+            return None
+        return loads(row.history)
+
+    def save(self, session_id, messages, summary=""):
+        session_id = self.key(session_id)
+        now = time.time()
+        values = {"history": dumps(messages, summary), "updated_at": now}
+        with self.db.begin() as connection:
+            updated = connection.execute(update(self.table).where(
+                self.table.c.session_id == session_id).values(**values)).rowcount
+            if not updated:
+                try:
+                    with connection.begin_nested():
+                        connection.execute(insert(self.table).values(session_id=session_id, **values))
+                except IntegrityError:
+                    # Another worker created the session first.
+                    connection.execute(update(self.table).where(
+                        self.table.c.session_id == session_id).values(**values))
+            if now - self._purged_at > self.purge_interval:
+                self._purged_at = now
+                connection.execute(delete(self.table).where(self.table.c.updated_at < now - self.ttl))
+
+
+class SessionHistory(BaseChatMessageHistory):
+    # Loaded from the backend on first use, then saved once per turn by the
+    # memory, after it has pruned or summarized the history.
+    def __init__(self, backend, session_id):
+        self.backend = backend
+        self.session_id = session_id
+        self._messages = None
+        self._summary = ""
+
+    def load(self):
+        if self._messages is None:
+            self._messages, self._summary = self.backend.load(self.session_id) or ([], "")
+
+    @property
+    def messages(self):
+        # The same list every time: the memories prune it in place.
+        self.load()
+        return self._messages
+
+    @property
+    def summary(self):
+        self.load()
+        return self._summary
+
+    def add_messages(self, messages):
+        self.messages.extend(messages)
+
+    def clear(self):
+        self._messages, self._summary = [], ""
+        self.save()
+
+    def save(self, summary=None):
+        if summary is not None:
+            self._summary = summary
+        self.backend.save(self.session_id, self.messages, self._summary)
+
+
+class TokenBufferMemory(ConversationTokenBufferMemory):
+    def save_context(self, inputs, outputs):
+        super().save_context(inputs, outputs)
+        self.chat_memory.save()
+
+
+class SummaryBufferMemory(ConversationSummaryBufferMemory):
+    def load_summary(self):
+        if not self.moving_summary_buffer:
+            self.moving_summary_buffer = self.chat_memory.summary
+
+    def load_memory_variables(self, inputs):
+        self.load_summary()
+        return super().load_memory_variables(inputs)
+
+    def save_context(self, inputs, outputs):
+        self.load_summary()
+        super().save_context(inputs, outputs)
+        self.chat_memory.save(self.moving_summary_buffer)
+
+
+class MemoryStore:
+    # Hands out a conversation memory per request over the session backend;
+    # each keeps at most ``max_token_limit`` tokens of history, and with
+    # ``summarize`` older turns are folded into a running summary instead.
+    def __init__(self, llm, backend, max_token_limit=2000, summarize=False):
+        self.llm = llm
+        self.backend = backend
+        self.max_token_limit = max_token_limit
+        self.summarize = summarize
+
+    def __len__(self):
+        return len(self.backend)
+
+    def get(self, user_id):
+        memory_class = SummaryBufferMemory if self.summarize else TokenBufferMemory
+        return memory_class(llm=self.llm,
+                            chat_memory=SessionHistory(self.backend, str(user_id)),
+                            max_token_limit=self.max_token_limit,
+                            memory_key='history',
+                            input_key='input',
+                            output_key='output',
+                            return_messages=True)
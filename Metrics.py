@@ -0,0 +1,138 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, generate_latest
+from prometheus_client import multiprocess
+
+# With several server processes (uvicorn --workers), set this to a directory
+# emptied before startup: every process writes its samples there and a scrape
+# of any of them merges all. Gauges then combine the live processes.
+MULTIPROCESS = bool(os.getenv("PROMETHEUS_MULTIPROC_DIR"))
+
+STAGE_SECONDS = Histogram("recommender_stage_seconds", "Time spent in each recommender stage.", ["stage"],
+                          buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60,
+                                   120, 300))
+REQUEST_SECONDS = Histogram("http_request_seconds", "Time to the response head, by route.", ["method", "route"])
+LOOKUPS = Counter("recommender_lookups_total",
+                  "Recommendation lookups by source: precomputed table, KNN or ALS scoring, or cold start.", ["source"])
+CANDIDATES = Histogram("recommender_candidates", "Products reachable from a user's neighbours when scoring.",
+                       buckets=(0, 1, 10, 50, 100, 500, 1000, 5000, 10000, 50000, 100000))
+# Across processes: the newest model's version and training time, and the
+# age of the oldest model still served.
+MODEL_VERSION = Gauge("recommender_model_version", "Version of the served KNN model.", multiprocess_mode="livemax")
+MODEL_TRAINED_AT = Gauge("recommender_model_trained_timestamp_seconds", "When the served KNN model was trained.",
+                         multiprocess_mode="livemax")
+MODEL_AGE = Gauge("recommender_model_age_seconds", "Seconds since the served KNN model was trained.",
+                  multiprocess_mode="livemax")
+# A shared session database gives every process the same count, so each
+# process is reported on its own (pid label) instead of summed.
+CHATBOT_SESSIONS = Gauge("chatbot_sessions", "Conversations held in memory.", multiprocess_mode="liveall")
+POOL_CONNECTIONS = Gauge("db_pool_connections", "Database pool connections by state.", ["database", "state"],
+                         multiprocess_mode="livesum")
+QUESTION_CACHE = Counter("chatbot_question_cache_total", "Chatbot questions answered from the cache or not.",
+                         ["result"])
+
+# Looked up once, the hot path only pays for the observation itself.
+TABLE_LOOKUPS = LOOKUPS.labels("table")
+MODEL_LOOKUPS = LOOKUPS.labels("model")
+ALS_LOOKUPS = LOOKUPS.labels("als")
+COLD_START_LOOKUPS = LOOKUPS.labels("cold_start")
+
+# Gauges read from a function, in multiprocess mode written by refresh().
+_functions = []
+_stop_refresher = threading.Event()
+
+
+@contextmanager
+def stage(name, durations=None):
+    # Work in a worker process records into ``durations`` for the parent to
+    # observe, as metrics recorded there are never scraped.
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        if durations is None:
+            STAGE_SECONDS.labels(name).observe(elapsed)
+        else:
+            durations[name] = elapsed
+
+
+def observe_stages(durations):
+    for name, elapsed in durations.items():
+        STAGE_SECONDS.labels(name).observe(elapsed)
+
+
+def model_swapped(model):
+    MODEL_VERSION.set(model.version)
+    MODEL_TRAINED_AT.set(model.trained_at)
+
+
+def set_function(gauge, fn):
+    # A multiprocess scrape only reads the shared files, so there the value
+    # is written whenever refresh() runs instead of read at scrape time. Some
+    # functions query a database, so refresh() never runs on the event loop.
+    if MULTIPROCESS:
+        _functions.append((gauge, fn))
+    else:
+        gauge.set_function(fn)
+
+
+def refresh():
+    for gauge, fn in _functions:
+        try:
+            gauge.set(fn())
+        except Exception as e:
+            print("Cannot refresh a metric: %s" % e)
+
+
+def start_refresher(interval):
+    # Keeps the values of processes that are not the one scraped current.
+    if not MULTIPROCESS or interval <= 0:
+        return
+    _stop_refresher.clear()
+    threading.Thread(target=_refresh_loop, args=(interval,), name="metrics-refresher", daemon=True).start()
+
+
+def _refresh_loop(interval):
+    while not _stop_refresher.wait(interval):
+        refresh()
+
+
+def watch_pool(engine):
+    pool = engine.pool
+    if not hasattr(pool, "overflow"):
+        return
+    url = engine.url
+    database = "%s://%s/%s" % (url.get_backend_name(), url.host or "", url.database or "")
+    set_function(POOL_CONNECTIONS.labels(database, "size"), pool.size)
+    set_function(POOL_CONNECTIONS.labels(database, "checked_out"), pool.checkedout)
+    set_function(POOL_CONNECTIONS.labels(database, "idle"), pool.checkedin)
+    # The pool counts overflow from -pool_size until the pool is full.
+    set_function(POOL_CONNECTIONS.labels(database, "overflow"), lambda: max(pool.overflow(), 0))
+
+
+def worker_started():
+    # Training workers return their timings instead; the gauges they created
+    # on import must not appear as those of a live process.
+    if MULTIPROCESS:
+        multiprocess.mark_process_dead(os.getpid())
+
+
+def process_exiting():
+    # Drops this process from the live gauges; counters and histograms keep
+    # what it recorded.
+    _stop_refresher.set()
+    if MULTIPROCESS:
+        multiprocess.mark_process_dead(os.getpid())
+
+
+def latest():
+    if not MULTIPROCESS:
+        return generate_latest(), CONTENT_TYPE_LATEST
+    refresh()
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return generate_latest(registry), CONTENT_TYPE_LATEST
@@ -0,0 +1,133 @@
+import hashlib
+import re
+import threading
+import time
+import unicodedata
+
+import numpy as np
+
+# Values a question is about must match exactly, however similar the rest is:
+# "top 5" and "top 10" embed almost the same.
+LITERALS = re.compile(r"[\w.+-]+@[\w-]+\.[\w.-]+|\"[^\"]*\"|'[^']*'|\w*\d\w*")
+
+
+def normalize(question):
+    question = unicodedata.normalize("NFC", question).lower()
+    return " ".join(question.split()).rstrip("?.!,; ")
+
+
+def literals(question):
+    return tuple(LITERALS.findall(question))
+
+
+def context_key(messages, turns=1):
+    # A follow-up ("and the cheapest one?") only means the same thing after
+    # the same last exchange; a fresh conversation has an empty context.
+    recent = messages[-2 * turns:] if messages else []
+    source = "\n".join("%s: %s" % (message.type, message.content) for message in recent)
+    return hashlib.sha256(source.encode("utf-8")).hexdigest() if source else ""
+
+
+class QuestionCache:
+    # Final answers by question embedding. A question hits an entry when the
+    # cosine similarity reaches ``threshold`` and its literals and context
+    # match; entries expire after ``ttl`` seconds and all are dropped when
+    # ``data_version`` (checked every ``check_interval`` seconds) changes.
+    def __init__(self, embeddings, threshold=0.95, ttl=600, max_entries=1000, data_version=None,
+                 check_interval=10):
+        self.embeddings = embeddings
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.data_version = data_version
+        self.check_interval = check_interval
+        self.entries = []
+        self.vectors = None
+        # Entries by normalized question and context: a repeat differing only
+        # in case or spacing hits whatever its embedding.
+        self.exact = {}
+        self.version = data_version() if data_version else None
+        self._checked_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def calibrate(self, questions, queries, vectors, margin=0.01):
+        # Raises the threshold above the similarity of any two example
+        # questions that would share an entry yet need different SQL, like
+        # "được đánh giá nhiều nhất" and "được đánh giá nhiều sao nhất".
+        # ``vectors`` are the examples' normalized embeddings, of the text as
+        # written like the questions looked up.
+        questions = [normalize(question) for question in questions]
+        keys = np.array([repr(literals(question)) for question in questions])
+        queries = np.array([" ".join(query.lower().split()).rstrip(";") for query in queries])
+        conflicts = ((keys[:, None] == keys[None, :]) & (queries[:, None] != queries[None, :])
+                     & (np.array(questions)[:, None] != np.array(questions)[None, :]))
+        if not conflicts.any():
+            return self.threshold
+        scores = np.where(conflicts, np.asarray(vectors) @ np.asarray(vectors).T, -np.inf)
+        i, j = np.unravel_index(np.argmax(scores), scores.shape)
+        # Capped below 1, so a repeat of the very same question still hits.
+        if scores[i, j] + margin > self.threshold:
+            self.threshold = max(self.threshold, min(float(scores[i, j]) + margin, 0.999))
+            print("Question cache threshold raised to %.3f: %r and %r are %.3f similar" % (
+                self.threshold, questions[i], questions[j], scores[i, j]))
+        return self.threshold
+
+    def embed(self, question):
+        # The question as asked, the text the example index embeds too, so a
+        # turn can share one vector between them.
+        vector = np.asarray(self.embeddings.embed_query(question), dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+    def lookup(self, question, context="", vector=None):
+        # Returns (answer or None, vector); pass the vector on to ``store``
+        # to avoid embedding the question twice.
+        self.check_data_version()
+        if vector is None:
+            vector = self.embed(question)
+        question = normalize(question)
+        key = literals(question)
+        now = time.monotonic()
+        with self._lock:
+            if not self.entries:
+                return None, vector
+            entry = self.exact.get((question, context))
+            if entry is not None and now - entry["stored_at"] < self.ttl:
+                return entry["answer"], vector
+            scores = self.vectors @ vector
+            for i in np.argsort(-scores):
+                if scores[i] < self.threshold:
+                    break
+                entry = self.entries[i]
+                if entry["literals"] == key and entry["context"] == context and now - entry["stored_at"] < self.ttl:
+                    return entry["answer"], vector
+        return None, vector
+
+    def store(self, question, answer, context="", vector=None):
+        if vector is None:
+            vector = self.embed(question)
+        now = time.monotonic()
+        with self._lock:
+            keep = [i for i, entry in enumerate(self.entries) if now - entry["stored_at"] < self.ttl]
+            keep = keep[max(0, len(keep) - self.max_entries + 1):]
+            self.entries = [self.entries[i] for i in keep]
+            self.entries.append({"question": normalize(question), "literals": literals(normalize(question)),
+                                 "context": context, "answer": answer, "stored_at": now})
+            self.exact = {(entry["question"], entry["context"]): entry for entry in self.entries}
+            previous = self.vectors[keep] if keep else np.empty((0, len(vector)), dtype=np.float32)
+            self.vectors = np.vstack([previous, vector[None, :]])
+
+    def clear(self):
+        with self._lock:
+            self.entries = []
+            self.vectors = None
+            self.exact = {}
+
+    def check_data_version(self):
+        if self.data_version is None or time.monotonic() - self._checked_at < self.check_interval:
+            return
+        self._checked_at = time.monotonic()
+        version = self.data_version()
+        if version != self.version:
+            self.version = version
+            self.clear()
@@ -0,0 +1,46 @@
+import time
+
+import numpy as np
+
+import ArrayStore
+
+
+class RecommendationTable:
+    def __init__(self, path):
+        arrays, meta = ArrayStore.load_arrays(path)
+        self.path = path
+        # index[user_id] is the user's row in offsets, or -1 for unknown users.
+        self.index = arrays["index"]
+        self.offsets = arrays["offsets"]
+        self.products = arrays["products"]
+        self.cold_start = arrays["cold_start"]
+        self.n = meta["n"]
+        self.version = meta["version"]
+        self.built_at = meta["built_at"]
+
+    def lookup(self, user_id: int, n: int = 10):
+        row = self.index[user_id] if 0 <= user_id < len(self.index) else -1
+        if row >= 0:
+            start, end = self.offsets[row], self.offsets[row + 1]
+            if end > start:
+                return self.products[start:min(end, start + n)].tolist()
+        return self.cold_start[:n].tolist()
+
+    @staticmethod
+    def build(model, path, n):
+        rows = np.arange(len(model.user_ids))
+        lists = list(model.iter_top_n(rows, n))
+        offsets = np.zeros(len(lists) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(products) for products in lists])
+        products = np.fromiter((p for products in lists for p in products), dtype=np.int32, count=offsets[-1])
+
+        index = np.full(int(model.user_ids.max()) + 1 if len(rows) else 0, -1, dtype=np.int32)
+        index[model.user_ids] = rows
+        arrays = {
+            "index": index,
+            "offsets": offsets,
+            "products": products,
+            "cold_start": np.asarray(model.get_top_rated_products(n), dtype=np.int32),
+        }
+        ArrayStore.save_arrays(path, arrays, {"n": n, "version": model.version, "built_at": time.time()})
+        return RecommendationTable(path)
@@ -0,0 +1,270 @@
+import argparse
+import asyncio
+import json
+import os
+import re
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict
+
+import numpy as np
+from langchain_community.embeddings import DeterministicFakeEmbedding
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.load import dump
+from langchain_core.messages import AIMessage, AIMessageChunk, HumanMessage, ToolMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from langchain_core.prompts import ChatPromptTemplate
+
+import Chatbot
+import MemoryStore
+
+# "prompt" is the agent's prompt formatting less the example selection in
+# it; "memory" is loading the history for the prompt and saving the turn,
+# with token counting and pruning, backend reads and writes included;
+# "callbacks" is LangChain serializing each chain, prompt and model for the
+# callbacks of its run. With concurrency above 1 every stage includes waits
+# for the GIL held by the other sessions.
+STAGES = ["example_selection", "prompt", "memory", "callbacks", "llm", "sql", "other"]
+# Timings of the turn running on the current thread.
+turn = threading.local()
+
+try:
+    import tiktoken
+    ENCODING = tiktoken.get_encoding("o200k_base")
+except Exception:
+    # No network to fetch the encoding: about four characters per token.
+    ENCODING = None
+
+
+def count_tokens(text):
+    return len(ENCODING.encode(text)) if ENCODING else (len(text) + 3) // 4
+
+
+def record(stage, seconds=0.0, **counts):
+    timings = getattr(turn, "timings", None)
+    if timings is None:
+        return
+    timings[stage] = timings.get(stage, 0.0) + seconds
+    for name, count in counts.items():
+        timings[name] = timings.get(name, 0) + count
+
+
+def timed(obj, method, stage):
+    original = getattr(obj, method)
+
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return original(*args, **kwargs)
+        finally:
+            record(stage, time.perf_counter() - start)
+    setattr(obj, method, wrapper)
+
+
+def build_sample_db(path, dump="dataSample.sql"):
+    # Converts the MySQL dump's tables and rows to SQLite, enough for the
+    # agent's queries: keys and MySQL-only column options are dropped.
+    with open(dump, encoding="utf-8") as f:
+        source = f.read()
+    escapes = {"0": "\0", "n": "\n", "r": "\r", "t": "\t", "Z": "\x1a"}
+
+    def literal(match):
+        value = re.sub(r"\\(.)", lambda e: escapes.get(e.group(1), e.group(1)), match.group(2))
+        if match.group(1):
+            # _binary '\0' and '\1' are bit(1) columns.
+            return str(ord(value[0]) if value else 0)
+        return "'" + value.replace("'", "''") + "'"
+
+    connection = sqlite3.connect(path)
+    for block in re.findall(r"CREATE TABLE .*?\) ENGINE=[^;]*;", source, re.S):
+        lines = block.splitlines()
+        columns = [line.strip().rstrip(",") for line in lines[1:-1]
+                   if not re.match(r"\s*(UNIQUE KEY|KEY|CONSTRAINT)", line)]
+        columns = [re.sub(r"AUTO_INCREMENT|COLLATE \w+|CHARACTER SET \w+", "", c) for c in columns]
+        connection.execute(lines[0] + "\n" + ",\n".join(columns) + "\n)")
+    for line in source.splitlines():
+        if line.startswith("INSERT INTO"):
+            connection.execute(re.sub(r"(_binary )?'((?:[^'\\]|\\.)*)'", literal, line))
+    connection.commit()
+    connection.close()
+
+
+def default_transcripts():
+    # One recorded turn per few-shot example: run its query, then answer.
+    return [{"question": example["input"],
+             "steps": [{"tool": "sql_db_query", "args": {"query": example["query"]}}],
+             "answer": "Đây là kết quả cho câu hỏi của bạn."}
+            for example in Chatbot.SQLAgent.examples]
+
+
+class ReplayChatModel(BaseChatModel):
+    # Answers each question with its transcript's next tool call, or with the
+    # final answer once every step has a tool result; the step is read from
+    # the messages, so concurrent sessions need no shared state. A prompt of
+    # no transcript comes from a tool, the query checker, and gets the query
+    # back unchanged.
+    transcripts: Dict[str, dict]
+    latency: float = 0.0
+
+    @property
+    def _llm_type(self):
+        return "replay"
+
+    def reply(self, messages):
+        start = time.perf_counter()
+        # The prompt puts the scratchpad before the input, and the history
+        # holds no tool results, so every ToolMessage is from this turn.
+        question = [message for message in messages if isinstance(message, HumanMessage)][-1]
+        transcript = self.transcripts.get(question.content)
+        step = sum(isinstance(message, ToolMessage) for message in messages)
+        if transcript is None:
+            message = AIMessage(content=question.content.split("\nDouble check")[0].strip())
+        elif step < len(transcript["steps"]):
+            call = transcript["steps"][step]
+            message = AIMessage(content="", additional_kwargs={"tool_calls": [{
+                "id": "call_%d" % step, "type": "function",
+                "function": {"name": call["tool"], "arguments": json.dumps(call["args"], ensure_ascii=False)}}]})
+        else:
+            message = AIMessage(content=transcript["answer"])
+        tokens = self.get_num_tokens_from_messages(messages)
+        if self.latency:
+            time.sleep(self.latency)
+        record("llm", time.perf_counter() - start, prompt_tokens=tokens, llm_calls=1)
+        return message
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        return ChatResult(generations=[ChatGeneration(message=self.reply(messages))])
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        # A tool call comes in one chunk, an answer word by word.
+        message = self.reply(messages)
+        if not message.content:
+            yield ChatGenerationChunk(message=AIMessageChunk(content="", additional_kwargs=message.additional_kwargs))
+            return
+        for word in re.findall(r"\S+\s*", message.content):
+            if run_manager:
+                run_manager.on_llm_new_token(word)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=word))
+
+    def get_num_tokens_from_messages(self, messages):
+        return sum(count_tokens(str(message.content)) + 4 for message in messages)
+
+
+def run_session(bot, store, session_id, questions):
+    results = []
+    for question in questions:
+        turn.timings = {}
+        start = time.perf_counter()
+        bot.run(question, store.get(session_id))
+        timings, turn.timings = turn.timings, None
+        timings["total"] = time.perf_counter() - start
+        timings["prompt"] = timings.get("prompt", 0.0) - timings.get("example_selection", 0.0)
+        timings["other"] = timings["total"] - sum(timings.get(stage, 0.0) for stage in STAGES[:-1])
+        results.append(timings)
+    return results
+
+
+def check_stream(bot, store):
+    # Only the agent's answer may reach a streaming client as tokens; the
+    # query checker's LLM call streams too, inside its tool.
+    example = Chatbot.SQLAgent.examples[0]
+    transcript = {"question": "stream check: " + example["input"],
+                  "steps": [{"tool": "sql_db_query_checker", "args": {"query": example["query"]}},
+                            {"tool": "sql_db_query", "args": {"query": example["query"]}}],
+                  "answer": "Đây là kết quả cho câu hỏi của bạn."}
+    bot.llm.transcripts[transcript["question"]] = transcript
+
+    async def stream():
+        return [(event, data) async for event, data in bot.astream(transcript["question"],
+                                                                  store.get("stream-check"))]
+    events = asyncio.run(stream())
+    streamed = "".join(data["content"] for event, data in events if event == "token")
+    tools = [data["tool"] for event, data in events if event == "tool_start"]
+    ok = streamed == transcript["answer"] and tools == ["sql_db_query_checker", "sql_db_query"]
+    print("stream check: %s (tools %s, tokens %r)" % ("OK" if ok else "MISMATCH", tools, streamed))
+    return ok
+
+
+def report(results, wall):
+    total = np.array([r["total"] for r in results]) * 1000
+    per_call = [r.get("prompt_tokens", 0) / r["llm_calls"] for r in results if r.get("llm_calls")]
+    print("turns %d, throughput %.1f turns/s" % (len(results), len(results) / wall))
+    print("turn latency ms: p50 %.1f  p95 %.1f  p99 %.1f" % tuple(np.percentile(total, [50, 95, 99])))
+    print("mean ms per turn: " + "  ".join("%s %.2f" % (stage, np.mean([r.get(stage, 0.0) for r in results]) * 1000)
+                                          for stage in STAGES))
+    print("llm calls per turn %.2f, prompt tokens per call: mean %.0f  p95 %.0f (%s)" % (
+        np.mean([r.get("llm_calls", 0) for r in results]), np.mean(per_call) if per_call else 0,
+        np.percentile(per_call, 95) if per_call else 0, "tiktoken" if ENCODING else "estimated"))
+    return {"turns": len(results), "throughput": len(results) / wall,
+            "p50_ms": float(np.percentile(total, 50)), "p95_ms": float(np.percentile(total, 95)),
+            "p99_ms": float(np.percentile(total, 99)),
+            "stages_ms": {stage: float(np.mean([r.get(stage, 0.0) for r in results]) * 1000) for stage in STAGES},
+            "prompt_tokens_per_call": float(np.mean(per_call)) if per_call else 0.0}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the SQL chatbot offline with a replayed LLM.")
+    parser.add_argument("--sessions", type=int, default=20)
+    parser.add_argument("--turns", type=int, default=5, help="questions per session")
+    parser.add_argument("--concurrency", type=int, default=4, help="sessions running at once")
+    parser.add_argument("--llm-latency", type=float, default=0.0, help="simulated seconds per LLM call")
+    parser.add_argument("--transcripts", help="JSON list of recorded turns: question, steps, answer")
+    parser.add_argument("--question-cache", action="store_true", help="enable the semantic question cache")
+    parser.add_argument("--db", help="SQLite database to use instead of one built from dataSample.sql")
+    parser.add_argument("--output", help="write results as JSON to this file")
+    args = parser.parse_args(argv)
+    os.environ["LANGCHAIN_TRACING_V2"] = "false"
+
+    if args.transcripts:
+        with open(args.transcripts, encoding="utf-8") as f:
+            transcripts = json.load(f)
+    else:
+        transcripts = default_transcripts()
+    llm = ReplayChatModel(transcripts={t["question"]: t for t in transcripts}, latency=args.llm_latency)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        db_path = args.db
+        if not db_path:
+            db_path = os.path.join(workdir, "filtro.db")
+            build_sample_db(db_path)
+        start = time.perf_counter()
+        bot = Chatbot.SQLAgent("sqlite:///" + db_path, llm=llm, embeddings=DeterministicFakeEmbedding(size=1536),
+                               cache_size=1000 if args.question_cache else 0, verbose=False)
+        print("agent built in %.2f s" % (time.perf_counter() - start))
+        store = MemoryStore.MemoryStore(llm, MemoryStore.LocalSessionBackend())
+        stream_ok = check_stream(bot, store)
+        timed(bot.example_selector, "select_examples", "example_selection")
+        timed(bot.db, "run", "sql")
+        prompt = next(step for step in bot.agent.agent.runnable.steps if isinstance(step, ChatPromptTemplate))
+        timed(type(prompt), "format_messages", "prompt")
+        for memory_class in (MemoryStore.TokenBufferMemory, MemoryStore.SummaryBufferMemory):
+            timed(memory_class, "load_memory_variables", "memory")
+            timed(memory_class, "save_context", "memory")
+        # Modules import dumpd by name, so each one's copy is wrapped.
+        dumpd = dump.dumpd
+        for module in list(sys.modules.values()):
+            if module.__name__.startswith("langchain") and vars(module).get("dumpd") is dumpd:
+                timed(module, "dumpd", "callbacks")
+
+        rng = np.random.default_rng(0)
+        sessions = [[transcripts[i]["question"] for i in rng.integers(0, len(transcripts), size=args.turns)]
+                    for _ in range(args.sessions)]
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            futures = [pool.submit(run_session, bot, store, "session-%d" % i, questions)
+                       for i, questions in enumerate(sessions)]
+            results = [timings for future in futures for timings in future.result()]
+        summary = report(results, time.perf_counter() - start)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(summary, f, indent=2)
+    return 0 if stream_ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,140 @@
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import create_engine
+
+import KNN
+
+# name: (reviews, users, products)
+SCALES = {
+    "10k": (10000, 1000, 500),
+    "100k": (100000, 10000, 5000),
+    "1m": (1000000, 100000, 20000),
+}
+
+
+def generate(db_url, reviews, users, products, seed=0):
+    # Product popularity is Zipf-like and ratings lean positive, roughly
+    # like the sample data; a few rows are replies that training must skip.
+    rng = np.random.default_rng(seed)
+    weights = 1 / np.arange(1, products + 1) ** 0.8
+    product_ids = rng.choice(np.arange(1, products + 1), size=reviews, p=weights / weights.sum())
+    review_df = pd.DataFrame({
+        "id": np.arange(1, reviews + 1),
+        "user_id": rng.integers(1, users + 1, size=reviews),
+        "product_id": product_ids,
+        "rating": rng.choice([1, 2, 3, 4, 5], size=reviews, p=[0.05, 0.07, 0.15, 0.33, 0.40]),
+        "comment": "synthetic review comment",
+        "created_at": pd.Timestamp("2024-01-01"),
+        "parent_id": np.where(rng.random(reviews) < 0.05, 1, None),
+    })
+    product_df = pd.DataFrame({
+        "id": np.arange(1, products + 1),
+        "name": ["product %s" % i for i in range(1, products + 1)],
+        "sold": rng.poisson(weights / weights.max() * 200),
+        "description": "synthetic product description " * 20,
+    })
+    db = create_engine(db_url)
+    review_df.to_sql("review", db, index=False, chunksize=50000)
+    product_df.to_sql("product", db, index=False, chunksize=50000)
+    db.dispose()
+
+
+def percentiles(samples):
+    values = np.percentile(np.asarray(samples) * 1000, [50, 95, 99])
+    return {"p50_ms": values[0], "p95_ms": values[1], "p99_ms": values[2]}
+
+
+def run_scale(name, requests, batch_users, workdir):
+    reviews, users, products = SCALES[name]
+    db_url = "sqlite:///" + os.path.join(workdir, "%s.db" % name)
+    generate(db_url, reviews, users, products)
+    db = create_engine(db_url)
+    result = {"scale": name, "reviews": reviews, "users": users, "products": products}
+
+    start = time.perf_counter()
+    df = KNN.load_ratings(db)
+    sales = KNN.load_sales(db)
+    result["load_s"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    model = KNN.KNNModel(df, 1, sales)
+    result["fit_s"] = time.perf_counter() - start
+
+    # Mostly known users, with the occasional cold start as in production.
+    rng = np.random.default_rng(1)
+    user_ids = rng.integers(1, int(users * 1.05) + 1, size=requests)
+    latencies = []
+    for user_id in user_ids:
+        start = time.perf_counter()
+        model.get_recommendations(int(user_id))
+        latencies.append(time.perf_counter() - start)
+    result.update(percentiles(latencies))
+
+    batch = [int(u) for u in rng.integers(1, users + 1, size=batch_users)]
+    start = time.perf_counter()
+    for _ in model.iter_recommendation_blocks(batch, 10):
+        pass
+    result["batch_users_per_s"] = len(batch) / (time.perf_counter() - start)
+
+    # ru_maxrss is in kilobytes on Linux.
+    result["peak_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    db.dispose()
+    return result
+
+
+COLUMNS = ["load_s", "fit_s", "p50_ms", "p95_ms", "p99_ms", "batch_users_per_s", "peak_rss_mb"]
+
+
+def report(results, baseline=None):
+    for result in results:
+        line = "%-6s" % result["scale"]
+        previous = (baseline or {}).get(result["scale"])
+        for column in COLUMNS:
+            cell = "%.3f" % result[column]
+            if previous and previous.get(column):
+                cell += " (%+.0f%%)" % ((result[column] / previous[column] - 1) * 100)
+            line += "%20s" % cell
+        print(line)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the KNN recommender on synthetic data.")
+    parser.add_argument("--scales", nargs="+", default=["10k", "100k"], choices=sorted(SCALES))
+    parser.add_argument("--requests", type=int, default=1000, help="single-user requests per scale")
+    parser.add_argument("--batch-users", type=int, default=5000, help="users per batch throughput run")
+    parser.add_argument("--output", help="write results as JSON to this file")
+    parser.add_argument("--baseline", help="JSON results of an earlier run to compare against")
+    args = parser.parse_args(argv)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = {result["scale"]: result for result in json.load(f)}
+
+    results = []
+    print("%-6s" % "scale" + "".join("%20s" % c for c in COLUMNS))
+    with tempfile.TemporaryDirectory() as workdir:
+        for name in args.scales:
+            # A fresh process per scale, so peak RSS belongs to that scale.
+            with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as pool:
+                results.append(pool.submit(run_scale, name, args.requests, args.batch_users, workdir).result())
+            report(results[-1:], baseline)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
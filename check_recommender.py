@@ -0,0 +1,94 @@
+import argparse
+import sys
+
+import numpy as np
+import pandas as pd
+from surprise import Dataset, KNNBasic, Reader
+
+import KNN
+
+
+def random_reviews(users, products, reviews, seed=0):
+    # Few ratings per user, so similarities tie often, and some users review
+    # the same product more than once.
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        "id": np.arange(1, reviews + 1),
+        "user_id": rng.integers(1, users + 1, size=reviews),
+        "product_id": rng.integers(1, products + 1, size=reviews),
+        "rating": rng.integers(1, 6, size=reviews),
+    })
+
+
+def reference(df):
+    # The engine the vectorized model replaced.
+    data = Dataset.load_from_df(df[["user_id", "product_id", "rating"]], Reader(rating_scale=KNN.KNNModel.rating_scale))
+    knn = KNNBasic(k=KNN.KNNModel.k, sim_options={"name": "cosine", "user_based": True}, verbose=False)
+    knn.fit(data.build_full_trainset())
+    return knn
+
+
+def compare(model, knn, df, n):
+    # Estimates of every product a user has not reviewed, and the top n of
+    # each user, ties going to the lower product id.
+    seen = df.groupby("user_id")["product_id"].agg(set)
+    rows = np.arange(len(model.user_ids))
+    estimates = model.estimate(rows)
+    top = model.top_n(rows, n)
+    worst, lists = 0.0, 0
+    for row, user_id in enumerate(model.user_ids):
+        expected = []
+        for column, product_id in enumerate(model.product_ids):
+            if product_id in seen[user_id]:
+                continue
+            est = knn.predict(user_id, product_id).est
+            worst = max(worst, abs(est - estimates[row, column]))
+            expected.append((-est, product_id))
+        if [int(product_id) for _, product_id in sorted(expected)[:n]] != top[row]:
+            lists += 1
+    return worst, lists
+
+
+def check(df, n, tolerance):
+    ok = True
+    knn = reference(df)
+    model = KNN.KNNModel(df, 1)
+    worst, lists = compare(model, knn, df, n)
+    print("full fit:    max estimate difference %.3g, top-%d lists differing %d of %d"
+          % (worst, n, lists, len(model.user_ids)))
+    ok &= worst <= tolerance and lists == 0
+
+    # An incremental update must give the model a full fit would.
+    split = len(df) * 3 // 4
+    updated = KNN.KNNModel(df.iloc[:split], 1).updated(df.iloc[split:], 2)
+    rows = updated.user_rows(model.user_ids)
+    columns = updated.product_rows(model.product_ids)
+    difference = np.abs(updated.estimate(rows)[:, columns] - model.estimate(np.arange(len(model.user_ids))))
+    same_lists = updated.top_n(rows, n) == model.top_n(np.arange(len(model.user_ids)), n)
+    print("incremental: max estimate difference %.3g, top-%d lists identical %s" % (difference.max(), n, same_lists))
+    ok &= difference.max() <= tolerance and same_lists
+    return ok
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Check the KNN model against surprise's KNNBasic.")
+    parser.add_argument("--users", type=int, default=300)
+    parser.add_argument("--products", type=int, default=200)
+    parser.add_argument("--reviews", type=int, default=3000)
+    parser.add_argument("--n", type=int, default=10, help="length of the compared top lists")
+    parser.add_argument("--seeds", type=int, default=3, help="random catalogs to check")
+    parser.add_argument("--tolerance", type=float, default=1e-9)
+    args = parser.parse_args(argv)
+
+    ok = True
+    for seed in range(args.seeds):
+        df = random_reviews(args.users, args.products, args.reviews, seed)
+        print("seed %d: %d reviews, %d repeated (user, product) pairs"
+              % (seed, len(df), df.duplicated(["user_id", "product_id"]).sum()))
+        ok &= check(df, args.n, args.tolerance)
+    print("OK" if ok else "MISMATCH")
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
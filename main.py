@@ -1,11 +1,22 @@
+import json
+import multiprocessing
 import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from dotenv import load_dotenv
-from typing import List
-from langchain.memory import ConversationBufferMemory
-from pydantic import BaseModel
+from typing import List, Literal
+from langchain_openai import ChatOpenAI
+from pydantic import BaseModel, Field
+import ALS
 import KNN
 import Chatbot
-from fastapi import FastAPI, HTTPException
+import Concurrency
+import Database
+import MemoryStore
+import Metrics
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse, Response as HTTPResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 
 load_dotenv()
@@ -20,6 +31,78 @@ DB_PASSWORD = "123456"
 DB_HOST = os.getenv("DB_HOST", "localhost")
 DB_PORT = 3306
 DATABASE = "filtro_jwt"
+# Every part of the service shares one connection pool per database.
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 10))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", 10))
+DB_POOL_TIMEOUT = int(os.getenv("DB_POOL_TIMEOUT", 10))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", 1800))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() == "true"
+RECOMMENDER_REFRESH_INTERVAL = int(os.getenv("RECOMMENDER_REFRESH_INTERVAL", 600))
+RECOMMENDER_DRIFT_THRESHOLD = float(os.getenv("RECOMMENDER_DRIFT_THRESHOLD", 0.2))
+# When set, recommendations are precomputed into this file after every
+# training and served from it by lookup.
+RECOMMENDER_TABLE_PATH = os.getenv("RECOMMENDER_TABLE_PATH")
+RECOMMENDER_TABLE_SIZE = int(os.getenv("RECOMMENDER_TABLE_SIZE", 10))
+# When set, every trained model is saved here and memory-mapped, so restarts
+# and other uvicorn workers start from it instead of retraining.
+RECOMMENDER_SNAPSHOT_PATH = os.getenv("RECOMMENDER_SNAPSHOT_PATH")
+# Training runs in this many worker processes (0 trains in-process); scoring
+# and chatbot calls run on bounded thread pools so the event loop stays free.
+RECOMMENDER_PROCESSES = int(os.getenv("RECOMMENDER_PROCESSES", 1))
+RECOMMENDER_THREADS = int(os.getenv("RECOMMENDER_THREADS", 4))
+RECOMMENDER_QUEUE_LIMIT = int(os.getenv("RECOMMENDER_QUEUE_LIMIT", 64))
+# Largest batch and list length /recommendations/batch accepts; a batch is
+# scored a block at a time on the recommender pool.
+RECOMMENDER_BATCH_LIMIT = int(os.getenv("RECOMMENDER_BATCH_LIMIT", 10000))
+RECOMMENDER_MAX_N = int(os.getenv("RECOMMENDER_MAX_N", 100))
+# The ALS engine (?engine=als) factorizes purchases, wishlists and taste
+# preferences with this many factors and iterations on this many threads,
+# retraining every this many seconds (0 trains on first use only).
+ALS_FACTORS = int(os.getenv("ALS_FACTORS", 64))
+ALS_ITERATIONS = int(os.getenv("ALS_ITERATIONS", 15))
+ALS_REGULARIZATION = float(os.getenv("ALS_REGULARIZATION", 0.1))
+ALS_ALPHA = float(os.getenv("ALS_ALPHA", 20))
+ALS_THREADS = int(os.getenv("ALS_THREADS", 4))
+ALS_REFRESH_INTERVAL = int(os.getenv("ALS_REFRESH_INTERVAL", 3600))
+# With PROMETHEUS_MULTIPROC_DIR set, every process writes its pool, session
+# and model age gauges this often (seconds), off the event loop.
+METRICS_REFRESH_INTERVAL = int(os.getenv("METRICS_REFRESH_INTERVAL", 15))
+AGENT_THREADS = int(os.getenv("AGENT_THREADS", 8))
+AGENT_QUEUE_LIMIT = int(os.getenv("AGENT_QUEUE_LIMIT", 32))
+# Chatbot turns waiting longer than this many seconds for an agent thread get
+# a 503. Each user has at most this many turns in flight, run one at a time
+# (more get a 429); a repeat of a turn still in flight shares its answer.
+AGENT_QUEUE_TIMEOUT = float(os.getenv("AGENT_QUEUE_TIMEOUT", 10))
+CHATBOT_USER_PENDING = int(os.getenv("CHATBOT_USER_PENDING", 2))
+# The few-shot examples are embedded once and kept here across restarts;
+# the default file in the working directory is ignored by git.
+CHATBOT_EXAMPLE_INDEX_PATH = os.getenv("CHATBOT_EXAMPLE_INDEX_PATH", "chatbot_examples.idx")
+# Seconds between checks of the database schema checksum; the agent's table
+# info is rebuilt only when it changes.
+CHATBOT_SCHEMA_CHECK_INTERVAL = int(os.getenv("CHATBOT_SCHEMA_CHECK_INTERVAL", 60))
+# Conversations are kept in this database when set (e.g.
+# sqlite:///chat_sessions.db, or the MySQL database for several workers and
+# replicas), otherwise in this process. Conversations beyond this many (in
+# process only), or idle for this many seconds, are dropped; each keeps this
+# many tokens of history, summarized instead when enabled. In a database, the
+# last turn saved wins when two workers answer the same user at once.
+CHATBOT_SESSION_DB = os.getenv("CHATBOT_SESSION_DB")
+CHATBOT_MAX_SESSIONS = int(os.getenv("CHATBOT_MAX_SESSIONS", 10000))
+CHATBOT_SESSION_TTL = int(os.getenv("CHATBOT_SESSION_TTL", 1800))
+CHATBOT_HISTORY_TOKENS = int(os.getenv("CHATBOT_HISTORY_TOKENS", 2000))
+CHATBOT_HISTORY_SUMMARY = os.getenv("CHATBOT_HISTORY_SUMMARY", "false").lower() == "true"
+# Answers are reused for questions this similar (cosine), with the same
+# numbers, codes and conversation context, for this many seconds or until the
+# data changes; a size of 0 disables the cache. The threshold is raised at
+# startup above any two few-shot questions that need different SQL.
+CHATBOT_CACHE_THRESHOLD = float(os.getenv("CHATBOT_CACHE_THRESHOLD", 0.95))
+CHATBOT_CACHE_TTL = int(os.getenv("CHATBOT_CACHE_TTL", 600))
+CHATBOT_CACHE_SIZE = int(os.getenv("CHATBOT_CACHE_SIZE", 1000))
+# SQL run by the agent returns at most this many rows and characters, and its
+# results are reused for this many seconds or until the data changes.
+CHATBOT_SQL_MAX_ROWS = int(os.getenv("CHATBOT_SQL_MAX_ROWS", 50))
+CHATBOT_SQL_MAX_CHARS = int(os.getenv("CHATBOT_SQL_MAX_CHARS", 8000))
+CHATBOT_SQL_CACHE_TTL = int(os.getenv("CHATBOT_SQL_CACHE_TTL", 60))
 
 
 app.add_middleware(
@@ -35,10 +118,110 @@ class Response(BaseModel):
     recommendations: List[int] | None
     detail: str | None
 
+
+class BatchRequest(BaseModel):
+    user_ids: List[int] = Field(max_length=RECOMMENDER_BATCH_LIMIT)
+    n: int = Field(10, gt=0, le=RECOMMENDER_MAX_N)
+    engine: Literal["knn", "als"] = "knn"
+
+
 connect_string = ('mysql+pymysql://{}:{}@{}:{}/{}'
                   .format(DB_USER, DB_PASSWORD, DB_HOST, DB_PORT, DATABASE))
-recommendations_service = KNN.KNN(connect_string)
-user_memory_dicts = {}
+Database.get_engine(connect_string, pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW,
+                    pool_timeout=DB_POOL_TIMEOUT, pool_recycle=DB_POOL_RECYCLE, pool_pre_ping=DB_POOL_PRE_PING)
+training_executor = None
+if RECOMMENDER_PROCESSES > 0:
+    training_executor = ProcessPoolExecutor(max_workers=RECOMMENDER_PROCESSES,
+                                            mp_context=multiprocessing.get_context("spawn"),
+                                            initializer=Metrics.worker_started)
+recommender_executor = Concurrency.BoundedExecutor(
+    ThreadPoolExecutor(max_workers=RECOMMENDER_THREADS, thread_name_prefix="recommender"),
+    RECOMMENDER_THREADS, RECOMMENDER_QUEUE_LIMIT)
+agent_executor = Concurrency.BoundedExecutor(
+    ThreadPoolExecutor(max_workers=AGENT_THREADS, thread_name_prefix="agent"),
+    AGENT_THREADS, AGENT_QUEUE_LIMIT, queue_timeout=AGENT_QUEUE_TIMEOUT)
+user_gate = Concurrency.UserGate(max_pending=CHATBOT_USER_PENDING)
+recommendations_service = KNN.KNN(connect_string,
+                                  table_path=RECOMMENDER_TABLE_PATH,
+                                  table_size=RECOMMENDER_TABLE_SIZE,
+                                  executor=training_executor,
+                                  drift_threshold=RECOMMENDER_DRIFT_THRESHOLD,
+                                  snapshot_path=RECOMMENDER_SNAPSHOT_PATH)
+als_service = ALS.ALS(connect_string,
+                      executor=training_executor,
+                      factors=ALS_FACTORS,
+                      regularization=ALS_REGULARIZATION,
+                      alpha=ALS_ALPHA,
+                      iterations=ALS_ITERATIONS,
+                      threads=ALS_THREADS)
+engines = {"knn": recommendations_service, "als": als_service}
+if CHATBOT_SESSION_DB:
+    session_backend = MemoryStore.SQLSessionBackend(CHATBOT_SESSION_DB, ttl=CHATBOT_SESSION_TTL)
+else:
+    session_backend = MemoryStore.LocalSessionBackend(max_sessions=CHATBOT_MAX_SESSIONS, ttl=CHATBOT_SESSION_TTL)
+# The LLM counts history tokens and, with summaries enabled, writes them.
+memory_store = MemoryStore.MemoryStore(ChatOpenAI(model=Chatbot.SQLAgent.model, temperature=0),
+                                       session_backend,
+                                       max_token_limit=CHATBOT_HISTORY_TOKENS,
+                                       summarize=CHATBOT_HISTORY_SUMMARY)
+chatbot = None
+chatbot_lock = threading.Lock()
+# Computed when scraped, so the age is current without a background timer;
+# with PROMETHEUS_MULTIPROC_DIR set, also every METRICS_REFRESH_INTERVAL.
+Metrics.set_function(Metrics.MODEL_AGE,
+                     lambda: time.time() - recommendations_service.model.trained_at
+                     if recommendations_service.model else 0)
+Metrics.set_function(Metrics.CHATBOT_SESSIONS, lambda: len(memory_store))
+
+
+@app.exception_handler(Concurrency.Saturated)
+async def saturated_handler(request: Request, exc: Concurrency.Saturated):
+    return JSONResponse(status_code=503, content={"detail": "Server is busy, please retry later"})
+
+
+@app.exception_handler(Concurrency.Busy)
+async def busy_handler(request: Request, exc: Concurrency.Busy):
+    return JSONResponse(status_code=429, content={"detail": "Please wait for the previous answer"},
+                        headers={"Retry-After": "1"})
+
+
+@app.middleware("http")
+async def observe_request_time(request: Request, call_next):
+    start = time.perf_counter()
+    response = await call_next(request)
+    # The route template keeps label values bounded, unlike the raw path.
+    route = request.scope.get("route")
+    Metrics.REQUEST_SECONDS.labels(request.method, route.path if route else "unmatched").observe(
+        time.perf_counter() - start)
+    return response
+
+
+@app.on_event("startup")
+def start_recommendations_service():
+    recommendations_service.open_table()
+    try:
+        if recommendations_service.load_snapshot() is None:
+            recommendations_service.load_data_and_train()
+    except Exception as e:
+        print("Initial KNN training failed, will train on first request: %s" % e)
+    recommendations_service.start_refresher(RECOMMENDER_REFRESH_INTERVAL)
+    als_service.start_refresher(ALS_REFRESH_INTERVAL)
+    Metrics.start_refresher(METRICS_REFRESH_INTERVAL)
+    try:
+        get_chatbot()
+    except Exception as e:
+        print("Building the chatbot agent failed, will retry on first message: %s" % e)
+
+
+@app.on_event("shutdown")
+def stop_recommendations_service():
+    recommendations_service.stop_refresher()
+    als_service.stop_refresher()
+    recommender_executor.shutdown()
+    agent_executor.shutdown()
+    if training_executor is not None:
+        training_executor.shutdown(wait=False, cancel_futures=True)
+    Metrics.process_exiting()
 
 
 @app.get("/")
@@ -51,20 +234,95 @@ async def say_hello(name: str):
     return {"message": f"Hello {name}"}
 
 
+@app.get("/metrics")
+def metrics():
+    # A plain def runs in FastAPI's threadpool, so rendering never blocks the
+    # event loop or waits behind the recommender and agent pools. With more
+    # than one worker, set PROMETHEUS_MULTIPROC_DIR so every scrape covers all.
+    body, content_type = Metrics.latest()
+    return HTTPResponse(content=body, media_type=content_type)
+
+
 @app.get("/recommendations/{user_id}", response_model=Response)
-async def recommendations(user_id: int):
-    re = recommendations_service.get_recommendations(user_id)
+async def recommendations(user_id: int, engine: Literal["knn", "als"] = "knn"):
+    re = await recommender_executor.run(engines[engine].get_recommendations, user_id)
+    return Response(recommendations=re, detail="Success")
+
+
+@app.post("/recommendations/batch")
+async def batch_recommendations(request: BatchRequest):
+    blocks = await recommender_executor.run(engines[request.engine].iter_recommendation_blocks,
+                                            request.user_ids, request.n)
+    # Every block is scored on the recommender pool; the first one before the
+    # response starts, so a failure there is still an error status.
+    block = await recommender_executor.run(next, blocks, None)
+
+    async def lines():
+        nonlocal block
+        while block is not None:
+            for user_id, re in block:
+                yield json.dumps({"user_id": user_id, "recommendations": re}) + "\n"
+            block = await recommender_executor.run(next, blocks, None)
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+
+def get_memory(user_id: str):
+    return memory_store.get(user_id)
+
+
+def run_agent(user_id: str, user_query: str):
+    response = get_chatbot().run(user_query, get_memory(user_id))
+    return response["output"]
+
+
+def get_chatbot():
+    global chatbot
+    with chatbot_lock:
+        if chatbot is None:
+            chatbot = Chatbot.SQLAgent(connect_string, example_index_path=CHATBOT_EXAMPLE_INDEX_PATH,
+                                       schema_check_interval=CHATBOT_SCHEMA_CHECK_INTERVAL,
+                                       cache_threshold=CHATBOT_CACHE_THRESHOLD,
+                                       cache_ttl=CHATBOT_CACHE_TTL,
+                                       cache_size=CHATBOT_CACHE_SIZE,
+                                       db_options={"max_rows": CHATBOT_SQL_MAX_ROWS,
+                                                   "max_result_chars": CHATBOT_SQL_MAX_CHARS,
+                                                   "result_ttl": CHATBOT_SQL_CACHE_TTL})
+    return chatbot
+
+
+@app.get("/products/{product_id}/similar", response_model=Response)
+async def similar_products(product_id: int, n: int = 10):
+    re = await recommender_executor.run(recommendations_service.get_similar_products, product_id, n)
     return Response(recommendations=re, detail="Success")
 
 
 @app.get("/chatbot/invoke/{user_id}")
 async def agent_invoke(user_id: str, user_query: str):
-    if user_id not in user_memory_dicts:
-        user_memory_dicts[user_id] = ConversationBufferMemory(memory_key='history',
-                                                              input_key='input',
-                                                              output_key='output',
-                                                              return_messages=True)
-    memory = user_memory_dicts[user_id]
-    chatbot = Chatbot.SQLAgent(connect_string, memory)
-    response = chatbot.run(user_query)
-    return response["output"]
\ No newline at end of file
+    return await user_gate.run(user_id, user_query, agent_executor.run, run_agent, user_id, user_query)
+
+
+@app.get("/chatbot/stream/{user_id}")
+async def agent_stream(user_id: str, user_query: str):
+    # Checked up front so a busy server answers 503, or a busy user 429,
+    # before the stream starts.
+    if agent_executor.saturated():
+        raise Concurrency.Saturated()
+    if user_gate.busy(user_id):
+        raise Concurrency.Busy()
+    # Building the agent blocks, so a first build happens on the agent pool.
+    bot = chatbot or await agent_executor.run(get_chatbot)
+
+    async def events():
+        try:
+            async with user_gate.turn(user_id), agent_executor.slot():
+                async for event, data in bot.astream(user_query, get_memory(user_id)):
+                    yield "event: %s\ndata: %s\n\n" % (event, json.dumps(data, ensure_ascii=False))
+        except (Concurrency.Saturated, Concurrency.Busy):
+            yield "event: error\ndata: %s\n\n" % json.dumps({"detail": "Server is busy, please retry later"})
+        except Exception as e:
+            print("Chatbot stream failed for user %s: %s" % (user_id, e))
+            yield "event: error\ndata: %s\n\n" % json.dumps({"detail": "The chatbot failed to answer"})
+
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
\ No newline at end of file